@@ -0,0 +1,264 @@
+# A benchmark runner for the hot paths in these recipes.
+#
+# Benchmarks are registered with the @benchmark decorator.  The decorated
+# function is a setup function: it is called once and returns the zero argument
+# callable that gets timed.  Each benchmark is warmed up, its loop count is
+# calibrated so one repeat takes about --repeat-time seconds, and then it is
+# repeated to get a distribution of per call timings.
+#
+#   python benchmarking_the_recipes.py                         # run them all
+#   python benchmarking_the_recipes.py -k countdown            # only some
+#   python benchmarking_the_recipes.py --save baseline.json    # keep results
+#   python benchmarking_the_recipes.py --baseline baseline.json --threshold 0.1
+#
+# With --baseline the run fails (exit status 1) if the median of any benchmark
+# is more than --threshold slower than the same benchmark in the baseline.
+
+import io
+import os
+import sys
+import json
+import time
+import logging
+import argparse
+import platform
+import importlib
+import statistics
+from timeit import Timer
+from contextlib import redirect_stdout
+
+_benchmarks = {}
+
+def benchmark(name):
+  '''register a setup function which returns the callable to time'''
+  def decorate(setup):
+    _benchmarks[name] = setup
+    return setup
+  return decorate
+
+def recipe(module_name):
+  '''import a recipe module, the recipes are scripts which print as they teach,
+  so their output is swallowed'''
+  with redirect_stdout(io.StringIO()):
+    return importlib.import_module(module_name)
+
+class BenchmarkRegression(Exception):
+  pass
+
+def run_benchmark(func, warmup=0.05, repeat=30, repeat_time=0.01):
+  '''time func, returns statistics of the per call time in nanoseconds'''
+  timer = Timer(func)
+  # warmup, and make sure a slow first call doesn't throw off the calibration
+  deadline = time.perf_counter() + warmup
+  while time.perf_counter() < deadline:
+    func()
+  # calibrate, grow the loop count until a repeat takes long enough to time
+  loops = 1
+  while True:
+    elapsed = timer.timeit(loops)
+    if elapsed >= repeat_time:
+      break
+    loops = max(loops * 2, int(loops * repeat_time / max(elapsed, 1e-9)))
+  per_call = sorted(t / loops * 1e9 for t in timer.repeat(repeat, loops))
+  cuts = statistics.quantiles(per_call, n=100, method='inclusive')
+  return {
+    'loops': loops,
+    'repeat': repeat,
+    'mean': statistics.fmean(per_call),
+    'stdev': statistics.stdev(per_call),
+    'min': per_call[0],
+    'p50': statistics.median(per_call),
+    'p90': cuts[89],
+    'p99': cuts[98],
+    'max': per_call[-1],
+  }
+
+def run(pattern=None, **options):
+  '''run the registered benchmarks whose name contains pattern'''
+  results = {}
+  with open(os.devnull, 'w') as devnull:
+    for name, setup in _benchmarks.items():
+      if pattern and pattern not in name:
+        continue
+      # recipes like timethis print on every call
+      with redirect_stdout(devnull):
+        results[name] = run_benchmark(setup(), **options)
+      print('{:52} {p50:12.1f} ns  (mean {mean:.1f} +/- {stdev:.1f}, '
+        'p90 {p90:.1f}, p99 {p99:.1f})'.format(name, **results[name]))
+  return results
+
+def save(results, path):
+  document = {
+    'python': platform.python_version(),
+    'implementation': platform.python_implementation(),
+    'machine': platform.machine(),
+    'created': time.strftime('%Y-%m-%dT%H:%M:%S'),
+    'benchmarks': results,
+  }
+  with open(path, 'w') as fp:
+    json.dump(document, fp, indent=2, sort_keys=True)
+
+def compare(results, baseline_path, threshold=0.10):
+  '''compare results with a saved baseline, raise BenchmarkRegression if any
+  benchmark's median got slower by more than threshold (0.10 is 10%)'''
+  with open(baseline_path) as fp:
+    baseline = json.load(fp)['benchmarks']
+  regressions = []
+  for name, current in sorted(results.items()):
+    if name not in baseline:
+      print('{:52} new benchmark, no baseline'.format(name))
+      continue
+    change = current['p50'] / baseline[name]['p50'] - 1.0
+    flag = 'REGRESSION' if change > threshold else ''
+    print('{:52} {:12.1f} -> {:12.1f} ns {:+7.1%} {}'.format(
+      name, baseline[name]['p50'], current['p50'], change, flag))
+    if flag:
+      regressions.append('{} {:+.1%}'.format(name, change))
+  if regressions:
+    raise BenchmarkRegression(
+      'slower than {} by more than {:.0%}: {}'.format(
+        baseline_path, threshold, ', '.join(regressions)))
+
+# The registered benchmarks
+N = 100
+
+@benchmark('countdown')
+def _():
+  countdown = recipe('putting_a_wrapper_around_a_function_1').countdown.__wrapped__
+  return lambda: countdown(N)
+
+@benchmark('countdown @timethis (print)')
+def _():
+  module = recipe('putting_a_wrapper_around_a_function_1')
+  countdown = module.timethis(module.countdown.__wrapped__)
+  return lambda: countdown(N)
+
+@benchmark('countdown @timethis(aggregate=True)')
+def _():
+  module = recipe('putting_a_wrapper_around_a_function_1')
+  countdown = module.timethis(aggregate=True)(module.countdown.__wrapped__)
+  return lambda: countdown(N)
+
+@benchmark('countdown @timethis_sampled(every=100)')
+def _():
+  module = recipe('putting_a_wrapper_around_a_function_1')
+  countdown = module.timethis_sampled(every=100)(module.countdown.__wrapped__)
+  return lambda: countdown(N)
+
+@benchmark('countdown @logged')
+def _():
+  module = recipe('wrapper_with_arguments_6')
+  # log to nowhere, so the decorator is measured and not the handler's I/O
+  log = logging.getLogger('benchmarks.logged')
+  log.setLevel(logging.DEBUG)
+  log.propagate = False
+  if not log.handlers:
+    log.addHandler(logging.NullHandler())
+  countdown = recipe('putting_a_wrapper_around_a_function_1').countdown.__wrapped__
+  countdown = module.logged(level=logging.DEBUG, name='benchmarks.logged')(countdown)
+  return lambda: countdown(N)
+
+@benchmark('countdown @logged (level disabled)')
+def _():
+  module = recipe('wrapper_with_arguments_6')
+  logging.getLogger('benchmarks.logged.disabled').setLevel(logging.WARNING)
+  countdown = recipe('putting_a_wrapper_around_a_function_1').countdown.__wrapped__
+  countdown = module.logged(level=logging.DEBUG,
+    name='benchmarks.logged.disabled')(countdown)
+  return lambda: countdown(N)
+
+@benchmark('countdown @typeassert')
+def _():
+  module = recipe('type_checking_with_a_decorator_7')
+  countdown = recipe('putting_a_wrapper_around_a_function_1').countdown.__wrapped__
+  countdown = module.typeassert(int)(countdown)
+  return lambda: countdown(N)
+
+@benchmark('countdown @Profiled')
+def _():
+  module = recipe('decorators_as_classes_9')
+  countdown = recipe('putting_a_wrapper_around_a_function_1').countdown.__wrapped__
+  countdown = module.Profiled(countdown)
+  return lambda: countdown(N)
+
+@benchmark('countdown @optional_debug')
+def _():
+  module = recipe('writing_decorators_that_add_args_to_wrapped_functions_11')
+  countdown = recipe('putting_a_wrapper_around_a_function_1').countdown.__wrapped__
+  countdown = module.optional_debug(countdown)
+  return lambda: countdown(N)
+
+@benchmark('Stock() OrderedMeta1 Structure (generated __init__)')
+def _():
+  Stock = recipe('capturing_class_attribute_definition_order_14').Stock
+  return lambda: Stock('GOOG', 100, 490.1)
+
+@benchmark('Stock() StructureMeta Structure (generated __init__)')
+def _():
+  Stock = recipe('enforcing_an_argument_signature_on_optional_arguments_16').Stock
+  return lambda: Stock('GOOG', 100, 490.1)
+
+@benchmark('MultiMethod dispatch')
+def _():
+  MultipleMeta = recipe(
+    'implementing_multiple_dispatch_with_function_annotations_20').MultipleMeta
+
+  class Spam(metaclass=MultipleMeta):
+    def bar(self, x:int, y:int):
+      return x + y
+
+    def bar(self, s:str, n:int = 0):
+      return s
+
+  spam = Spam()
+  def dispatch():
+    spam.bar(2, 3)
+    spam.bar('hello')
+  return dispatch
+
+@benchmark('Cached lookup')
+def _():
+  Cached = recipe('using_a_meta_class_to_control_instance_creation_13').Cached
+
+  class Spam(metaclass=Cached):
+    def __init__(self, name):
+      self.name = name
+
+  # hold a strong reference, the cache is a WeakValueDictionary; the timed
+  # callable has to close over it or it goes when this function returns
+  keep = Spam('Guido')
+  return lambda: (keep, Spam('Guido'))[1]
+
+@benchmark('thread safe attribute get/set')
+def _():
+  a = recipe('thread_safe_attributes').A1()
+  def get_set():
+    a.name = a.name
+  a.name = 'bob'
+  return get_set
+
+def main(argv=None):
+  parser = argparse.ArgumentParser(description='benchmark the recipes')
+  parser.add_argument('-k', '--filter', help='only run benchmarks matching this')
+  parser.add_argument('--save', help='write the results to this json file')
+  parser.add_argument('--baseline', help='compare against this json file')
+  parser.add_argument('--threshold', type=float, default=0.10,
+    help='allowed slow down before failing (0.10 is 10%%)')
+  parser.add_argument('--repeat', type=int, default=30)
+  parser.add_argument('--repeat-time', type=float, default=0.01,
+    help='seconds each repeat should take once calibrated')
+  args = parser.parse_args(argv)
+
+  results = run(args.filter, repeat=args.repeat, repeat_time=args.repeat_time)
+  if args.save:
+    save(results, args.save)
+  if args.baseline:
+    try:
+      compare(results, args.baseline, args.threshold)
+    except BenchmarkRegression as e:
+      print('FAILED:', e, file=sys.stderr)
+      return 1
+  return 0
+
+if __name__ == '__main__':
+  sys.exit(main())
@@ -1,18 +1,51 @@
 # if you want to automatically record the order in which attributes and methods
 # are defined inside a class body so that you can use it in various operations
 # (eg. serialization, mapping to databases, etc).
-from collections import OrderedDict
+import os
+import sys
+import csv
+import time
+import tempfile
+import tracemalloc
+import itertools
+from array import array
+from collections import OrderedDict, deque
+from concurrent.futures import ProcessPoolExecutor
+from operator import attrgetter, itemgetter
+from timeit import Timer
+
+from type_checking_with_a_decorator_7 import ArraySpec, trusted, np
+
+_SLOT = '_field_'
 
 # A set of descriptors for various types
-class Typed:
+#
+# The value of a field is kept in a slot named after it with the prefix
+# _SLOT (name -> _field_name), so a field can be called anything without its
+# slot clashing with the class's own private names (_order, _converters...).
+# Typed is a property whose getter is an
+# attrgetter of that slot, so reading a field never runs any Python code; only
+# writes go through __set__, which checks the value.
+class Typed(property):
   _expected_type = type(None)
   def __init__(self, name=None):
     self._name = name
+    if name is not None:
+      self._set_name(name)
 
-  def __set__(self, instance, value):
+  def _set_name(self, name):
+    self._name = name
+    self._slot = _SLOT + name
+    self._message = 'Expected ' + str(self._expected_type)
+    property.__init__(self, attrgetter(self._slot))
+
+  def validate(self, value):
     if not isinstance(value, self._expected_type):
-      raise TypeError('Expected ' + str(self._expected_type))
-    instance.__dict__[self._name] = value
+      raise TypeError(self._message)
+
+  def __set__(self, instance, value):
+    self.validate(value)
+    setattr(instance, self._slot, value)
 
 class Integer(Typed):
   _expected_type = int
@@ -23,43 +56,537 @@ class Float(Typed):
 class String(Typed):
   _expected_type = str
 
+class Array(Typed):
+  '''a NumPy array matching an ArraySpec, Array(dtype='float64', ndim=2,
+  finite=True), the check is skipped inside of a trusted() block'''
+  def __init__(self, name=None, **spec):
+    self._spec = ArraySpec(**spec)
+    super().__init__(name)
+
+  def validate(self, value):
+    if not self._spec.check(value):
+      raise TypeError('Expected ' + repr(self._spec))
+
+# The metaclass writes the methods of a class out from its field order, for
+# a Stock with name, shares and price:
+#
+#   def __init__(self, name, shares, price):
+#     if not isinstance(name, _type_name):
+#       raise TypeError(_message_name)
+#     ...
+#     self._field_name = name
+#     self._field_shares = shares
+#     self._field_price = price
+#
+#   def __eq__(self, other):
+#     if other.__class__ is self.__class__:
+#       return (self._field_name, self._field_shares, self._field_price) == (
+#         other._field_name, other._field_shares, other._field_price)
+#     return NotImplemented
+#
+# with __hash__, __repr__ and as_tuple made the same way.  Every field is
+# checked before any is stored.  Descriptors that check more than the type
+# (like Array) are called through their validate method.  A class which
+# defines one of these methods itself keeps its own.  The records hash by
+# value: don't change the fields of one which is a key in a dict.  A record
+# with such a field isn't hashable (__hash__ is None), and its __eq__ compares
+# the fields one at a time, Array fields with np.array_equal.
+def _generate(clsname, fields, descriptors):
+  slots = ['self.' + _SLOT + name for name in fields]
+  others = ['other.' + _SLOT + name for name in fields]
+  # a one field tuple needs its trailing comma
+  row = '({},)'.format(', '.join(slots)) if fields else '()'
+  other_row = '({},)'.format(', '.join(others)) if fields else '()'
+  namespace = {}
+  lines = ['def __init__(self{}):'.format(''.join(', ' + name for name in fields))]
+  for name, descriptor in zip(fields, descriptors):
+    if type(descriptor).validate is Typed.validate:
+      namespace['_type_' + name] = descriptor._expected_type
+      namespace['_message_' + name] = descriptor._message
+      lines += ['  if not isinstance({0}, _type_{0}):'.format(name),
+        '    raise TypeError(_message_{})'.format(name)]
+    else:
+      namespace['_validate_' + name] = descriptor.validate
+      lines.append('  _validate_{0}({0})'.format(name))
+  lines += ['  {} = {}'.format(slot, name) for slot, name in zip(slots, fields)] or [
+    '  pass']
+  plain = all(type(d).validate is Typed.validate for d in descriptors)
+  if plain:
+    lines += [
+      'def __eq__(self, other):',
+      '  if other.__class__ is self.__class__:',
+      '    return {} == {}'.format(row, other_row),
+      '  return NotImplemented',
+      'def __hash__(self):',
+      '  return hash({})'.format(row)]
+  else:
+    namespace['_array_equal'] = np.array_equal if np is not None else None
+    comparisons = [
+      '_array_equal({}, {})'.format(slot, other) if isinstance(d, Array)
+      else '{} == {}'.format(slot, other)
+      for slot, other, d in zip(slots, others, descriptors)]
+    lines += [
+      'def __eq__(self, other):',
+      '  if other.__class__ is self.__class__:',
+      '    return bool({})'.format(' and '.join(comparisons)),
+      '  return NotImplemented',
+      '__hash__ = None']
+  lines += [
+    'def __repr__(self):',
+    '  return {!r}.format({})'.format(
+      clsname + '(' + ', '.join('{!r}' for name in fields) + ')', ', '.join(slots)),
+    'def as_tuple(self):',
+    '  return {}'.format(row),
+  ]
+  exec('\n'.join(lines) + '\n', namespace)
+  methods = {}
+  for method in ('__init__', '__eq__', '__hash__', '__repr__', 'as_tuple'):
+    methods[method] = namespace[method]
+    if methods[method] is not None:
+      methods[method].__qualname__ = '{}.{}'.format(clsname, method)
+  return methods
+
 # Metaclass that uses an OrderedDict for class body
 class OrderedMeta1(type):
   def __new__(cls, clsname, bases, clsdict):
     d = dict(clsdict)
     order = []
+    descriptors = []
+    for base in reversed(bases):
+      for name in getattr(base, '_order', ()):
+        if name not in order:
+          order.append(name)
+          descriptors.append(getattr(base, name))
+    own = []
     for name, value in clsdict.items():
       if isinstance(value, Typed):
-        value._name = name
-        order.append(name)
+        value._set_name(name)
+        own.append(name)
+        if name in order:
+          descriptors[order.index(name)] = value
+        else:
+          order.append(name)
+          descriptors.append(value)
     d['_order'] = order
+    if '__slots__' not in d:
+      d['__slots__'] = tuple(_SLOT + name for name in own)
+    if '__eq__' in d and '__hash__' not in d:
+      # a class comparing its own way isn't hashable, unless it says how
+      d['__hash__'] = None
+    for method, function in _generate(clsname, order, descriptors).items():
+      d.setdefault(method, function)
     return type.__new__(cls, clsname, bases, d)
 
   @classmethod
   def __prepare__(cls, clsname, bases):
     return OrderedDict()
 
+# Bulk CSV.  write_csv pulls a row tuple out of each record with one
+# attrgetter of all of the slots and lets csv.writer format them.  read_csv
+# reads chunk_size rows at a time, turns each chunk into columns and converts
+# a column with one map() of the descriptor's type (str columns are left
+# alone), then builds the records from the columns, so the memory used is a
+# chunk no matter how big the file is.  With processes=N the text of the
+# chunks is parsed and converted in a process pool, which assumes no field
+# has a newline in it; the records are still made (and checked) here.
+def _open(file, mode):
+  if isinstance(file, (str, os.PathLike)):
+    return open(file, mode, newline='')
+  return None
+
+def _columns(rows, converters):
+  rows = list(rows)
+  return [list(map(itemgetter(i), rows)) if convert is None
+    else list(map(convert, map(itemgetter(i), rows)))
+    for i, convert in enumerate(converters)] if rows else []
+
+def _parse_chunk(lines, converters):
+  '''what a pool process does with a chunk of the file'''
+  return _columns(csv.reader(lines), converters)
+
 class Structure(metaclass=OrderedMeta1):
+  __slots__ = ()
   def as_csv(self):
-    return ",".join(str(getattr(self, name)) for name in self._order)
+    return ",".join(str(value) for value in self.as_tuple())
+
+  @classmethod
+  def _converters(cls):
+    converters = []
+    for name in cls._order:
+      descriptor = getattr(cls, name)
+      convert = descriptor._expected_type
+      if isinstance(descriptor, Array) or not callable(convert):
+        raise TypeError('{}.{} can\'t be read from csv'.format(cls.__name__, name))
+      converters.append(None if convert is str else convert)
+    return converters
+
+  @classmethod
+  def write_csv(cls, records, file, header=True):
+    '''write records (any iterable of cls) to file, a path or a text file
+    opened with newline='''''
+    opened = _open(file, 'w')
+    try:
+      writer = csv.writer(opened or file)
+      if header:
+        writer.writerow(cls._order)
+      row = attrgetter(*(_SLOT + name for name in cls._order))
+      if len(cls._order) == 1:
+        # attrgetter of one name doesn't make a tuple
+        writer.writerows((row(record),) for record in records)
+      else:
+        writer.writerows(map(row, records))
+    finally:
+      if opened:
+        opened.close()
+
+  @classmethod
+  def read_csv(cls, file, header=True, chunk_size=1000, processes=None):
+    '''yield the records in file (a path or a text file) written by
+    write_csv'''
+    for columns in cls._read_columns(file, header, chunk_size, processes):
+      yield from map(cls, *columns)
+
+  @classmethod
+  def array(cls, records=()):
+    '''a StructureArray of cls holding records'''
+    return StructureArray(cls, records)
+
+  @classmethod
+  def _read_columns(cls, file, header, chunk_size, processes):
+    '''the converted columns of each chunk of file'''
+    converters = cls._converters()
+    opened = _open(file, 'r')
+    try:
+      lines = opened or file
+      if header:
+        names = next(csv.reader(lines), None)
+        if names is not None and names != cls._order:
+          raise ValueError('{} has the columns {}, expected {}'.format(
+            getattr(lines, 'name', 'the file'), names, cls._order))
+      if processes:
+        chunks = _pooled_chunks(lines, converters, chunk_size, processes)
+      else:
+        reader = csv.reader(lines)
+        chunks = iter(lambda: _columns(
+          itertools.islice(reader, chunk_size), converters), [])
+      yield from chunks
+    finally:
+      if opened:
+        opened.close()
+
+def _pooled_chunks(lines, converters, chunk_size, processes):
+  '''the converted columns of each chunk, in order, with no more than two
+  chunks per process in flight'''
+  # sending a chunk to another process costs more than parsing a small one
+  chunk_size = max(chunk_size, 10000)
+  with ProcessPoolExecutor(processes) as pool:
+    pending = deque()
+    for chunk in iter(lambda: list(itertools.islice(lines, chunk_size)), []):
+      pending.append(pool.submit(_parse_chunk, chunk, converters))
+      if len(pending) >= 2 * processes:
+        yield pending.popleft().result()
+    while pending:
+      yield pending.popleft().result()
+
+# A StructureArray keeps the records of a Structure class column by column
+# instead of as objects: Integer and Float fields in array.array('q') and
+# array.array('d'), String fields as array.array('I') codes into a pool of
+# interned strings (a ticker symbol repeated a million times is stored once),
+# anything else in a list.  A row costs 8 bytes per numeric field and 4 per
+# string field, where a Stock object costs more than a hundred.
+#
+# With NumPy, sa.shares (or sa.column('shares')) is an ndarray sharing the
+# column's memory, so sa.shares * sa.price is a vectorized expression (and
+# sa.shares[i] = n writes through).  The column can't grow while one of those
+# is alive, extending it then raises BufferError.  Without NumPy the column is
+# handed out as the array.array itself.  sa[i] is a view of row i, it reads
+# the columns when its fields are read.
+_kinds = {str: 'str', int: 'q', float: 'd'}
+
+def _column_kinds(cls):
+  return [_kinds.get(getattr(cls, name)._expected_type, 'object')
+    for name in cls._order]
+
+class StructureArray:
+  def __init__(self, cls, records=(), chunk_size=10000):
+    self.cls = cls
+    self._fields = cls._order
+    self._kinds = _column_kinds(cls)
+    self._data = []
+    self._pools = {}
+    for name, kind in zip(self._fields, self._kinds):
+      if kind == 'str':
+        self._data.append(array('I'))
+        self._pools[name] = ([], {})
+      elif kind == 'object':
+        self._data.append([])
+      else:
+        self._data.append(array(kind))
+    self._row = _row_view(cls)
+    self.extend(records, chunk_size)
+
+  def __len__(self):
+    return len(self._data[0]) if self._data else 0
+
+  def extend(self, records, chunk_size=10000):
+    '''add records (instances of cls), chunk_size at a time'''
+    fields = self._fields
+    if not fields:
+      return
+    row = attrgetter(*(_SLOT + name for name in fields))
+    records = iter(records)
+    while True:
+      rows = list(map(row, itertools.islice(records, chunk_size)))
+      if not rows:
+        return
+      if len(fields) == 1:
+        rows = [(value,) for value in rows]
+      self._extend_columns(
+        [list(map(itemgetter(i), rows)) for i in range(len(fields))])
+
+  def append(self, record):
+    self.extend((record,))
+
+  def _extend_columns(self, columns):
+    if len(set(map(len, columns))) > 1:
+      raise ValueError('columns of different lengths')
+    # every column is converted before any is extended, so a bad value
+    # leaves the columns the same length
+    converted = []
+    for name, kind, column in zip(self._fields, self._kinds, columns):
+      if kind == 'str':
+        strings, index = self._pools[name]
+        for value in set(column).difference(index):
+          if not isinstance(value, str):
+            raise TypeError('Expected ' + str(str))
+          index[value] = len(strings)
+          strings.append(sys.intern(value))
+        converted.append(array('I', map(index.__getitem__, column)))
+      elif kind == 'object':
+        converted.append(column)
+      else:
+        # array() checks the types of a numeric column itself
+        converted.append(array(kind, column))
+    for data, column in zip(self._data, converted):
+      data.extend(column)
+
+  @classmethod
+  def read_csv(cls, record_cls, file, header=True, chunk_size=10000, processes=None):
+    '''a StructureArray of record_cls filled from a file written by write_csv,
+    the columns go straight in without making any records'''
+    sa = cls(record_cls)
+    for columns in record_cls._read_columns(file, header, chunk_size, processes):
+      sa._extend_columns(columns)
+    return sa
+
+  def column(self, name):
+    '''the column of a field, see above'''
+    try:
+      i = self._fields.index(name)
+    except ValueError:
+      raise AttributeError(name) from None
+    kind, data = self._kinds[i], self._data[i]
+    if kind == 'str':
+      strings = self._pools[name][0]
+      return list(map(strings.__getitem__, data))
+    if np is not None and kind != 'object':
+      return np.frombuffer(data, dtype=kind)
+    return data
+
+  def codes(self, name):
+    '''the pool codes of a String column and the strings they stand for'''
+    codes, strings = self._data[self._fields.index(name)], self._pools[name][0]
+    if np is not None:
+      codes = np.frombuffer(codes, dtype='I')
+    return codes, strings
+
+  def __getattr__(self, name):
+    if name.startswith('_'):
+      raise AttributeError(name)
+    return self.column(name)
+
+  def __getitem__(self, index):
+    if index < 0:
+      index += len(self)
+    if not 0 <= index < len(self):
+      raise IndexError('StructureArray index out of range')
+    return self._row(self, index)
+
+  def __iter__(self):
+    row = self._row
+    return (row(self, index) for index in range(len(self)))
+
+  def records(self):
+    '''the rows as instances of cls'''
+    columns = [self.column(name) for name in self._fields]
+    if np is not None:
+      columns = [column.tolist() if isinstance(column, np.ndarray) else column
+        for column in columns]
+    return map(self.cls, *columns)
+
+  def __repr__(self):
+    return '<StructureArray of {} {} rows>'.format(len(self), self.cls.__name__)
+
+_row_views = {}
+
+def _row_view(cls):
+  '''the class of the row views of a Structure class, made once'''
+  try:
+    return _row_views[cls]
+  except KeyError:
+    pass
+
+  def field(i, name, kind):
+    if kind == 'str':
+      def get(row):
+        return row._array._pools[name][0][row._array._data[i][row._index]]
+    else:
+      def get(row):
+        return row._array._data[i][row._index]
+    return property(get)
+
+  def as_tuple(row):
+    return tuple(getattr(row, name) for name in cls._order)
+
+  def __repr__(row):
+    return '{}{!r}'.format(cls.__name__, row.as_tuple())
+
+  def __init__(row, sa, index):
+    row._array = sa
+    row._index = index
+
+  namespace = {'__slots__': ('_array', '_index'), '__init__': __init__,
+    'as_tuple': as_tuple, '__repr__': __repr__,
+    'record': lambda row: cls(*row.as_tuple())}
+  for i, (name, kind) in enumerate(zip(cls._order, _column_kinds(cls))):
+    namespace[name] = field(i, name, kind)
+  view = _row_views[cls] = type(cls.__name__ + 'Row', (), namespace)
+  return view
 
 # Example use
 class Stock(Structure):
   name = String()
   shares = Integer()
   price = Float()
-  def __init__(self, name, shares, price):
-    self.name = name
-    self.shares = shares
-    self.price = price
+  # __init__(self, name, shares, price) is written by OrderedMeta1
 
 s = Stock('GOOG', 100, 490.1)
 print(s.name)
 print(s.as_csv())
+print(s, s == Stock('GOOG', 100, 490.1), {s: 'GOOG'}[Stock('GOOG', 100, 490.1)])
 
 # this is suppose to crash the program (uncomment to see)
 # t = Stock('AAPL', 'a lot', 610.23)
 
+def benchmark_records(count=100000, repeat=5):
+  '''the generated __init__ against one setting each field through its
+  descriptor, and a join of two lists of records through a dict'''
+  class SetStock(Structure):
+    name = String()
+    shares = Integer()
+    price = Float()
+    def __init__(self, name, shares, price):
+      self.name = name
+      self.shares = shares
+      self.price = price
+
+  for label, cls in (('descriptor __init__', SetStock), ('generated __init__', Stock)):
+    cost = min(Timer(lambda: cls('GOOG', 100, 490.1)).repeat(repeat, count)) / count
+    print('{:20} {:8.1f} ns per instance'.format(label, cost * 1e9))
+  read = min(Timer(lambda: s.shares).repeat(repeat, count)) / count
+  print('{:20} {:8.1f} ns'.format('read a field', read * 1e9))
+
+  left = [Stock('S{}'.format(i % 1000), i, 1.0) for i in range(count)]
+  right = [Stock('S{}'.format(i % 1000), i, 1.0) for i in range(count)]
+  def join():
+    index = {record: record for record in left}
+    return sum(1 for record in right if record in index)
+  cost = min(Timer(join).repeat(repeat, 1))
+  print('{:20} {:8.1f} ns per record ({} matched)'.format(
+    'dict join', cost / count * 1e9, join()))
+
+def benchmark_csv(rows=10000000, processes=os.cpu_count()):
+  '''write and read back a file of rows Stocks, one record at a time with
+  as_csv and with write_csv/read_csv'''
+  # the same thousand records over and over, so making them isn't timed
+  records = [Stock('S{}'.format(i % 500), i, i * 0.5) for i in range(1000)]
+  def stocks():
+    return itertools.islice(itertools.cycle(records), rows)
+
+  with tempfile.TemporaryDirectory() as directory:
+    path = os.path.join(directory, 'stocks.csv')
+    start = time.perf_counter()
+    with open(path, 'w') as fp:
+      for record in stocks():
+        fp.write(record.as_csv() + '\n')
+    as_csv = time.perf_counter() - start
+
+    start = time.perf_counter()
+    Stock.write_csv(stocks(), path)
+    written = time.perf_counter() - start
+    size = os.path.getsize(path)
+
+    start = time.perf_counter()
+    with open(path) as fp:
+      next(fp)
+      count = 0
+      for line in fp:
+        name, shares, price = line.rstrip('\n').split(',')
+        Stock(name, int(shares), float(price))
+        count += 1
+    per_line = time.perf_counter() - start
+
+    timings = [('as_csv per record', as_csv), ('write_csv', written),
+      ('split per line', per_line)]
+    for label, options in (('read_csv', {}),
+        ('read_csv {} processes'.format(processes), {'processes': processes})):
+      start = time.perf_counter()
+      count = sum(1 for record in Stock.read_csv(path, **options))
+      timings.append((label, time.perf_counter() - start))
+      assert count == rows, count
+
+  print('{} rows, {:.0f} MB'.format(rows, size / 1e6))
+  for label, seconds in timings:
+    print('{:24} {:8.2f} s {:12.0f} rows/s'.format(label, seconds, rows / seconds))
+
+def benchmark_structure_array(rows=1000000, repeat=3):
+  '''bytes per row and the time to total shares * price, a list of Stock
+  instances against a StructureArray'''
+  def stocks():
+    return (Stock('S{}'.format(i % 500), i, i * 0.5) for i in range(rows))
+
+  tracemalloc.start()
+  start = tracemalloc.get_traced_memory()[0]
+  instances = list(stocks())
+  list_bytes = tracemalloc.get_traced_memory()[0] - start
+  start = tracemalloc.get_traced_memory()[0]
+  sa = Stock.array(stocks())
+  array_bytes = tracemalloc.get_traced_memory()[0] - start
+  tracemalloc.stop()
+
+  totals = [('list of Stock', lambda: sum(s.shares * s.price for s in instances)),
+    ('row views', lambda: sum(row.shares * row.price for row in sa))]
+  if np is not None:
+    totals.append(('StructureArray columns', lambda: float((sa.shares * sa.price).sum())))
+  print('{:24} {:8.1f} bytes per row'.format('list of Stock', list_bytes / rows))
+  print('{:24} {:8.1f} bytes per row'.format('StructureArray', array_bytes / rows))
+  for label, total in totals:
+    seconds = min(Timer(total).repeat(repeat, 1))
+    print('{:24} {:8.1f} ns per row  total {:.6g}'.format(
+      label, seconds / rows * 1e9, total()))
+
+if np is not None:
+  class Prices(Structure):
+    symbol = String()
+    history = Array(dtype='float64', ndim=1, finite=True, minimum=0)
+    # Array is a Typed, so Prices('GOOG', history) checks the array too
+
+  p = Prices('GOOG', np.array([490.1, 491.5, 488.0]))
+  print(p.history.mean())
+  with trusted():
+    # an internal caller which has already checked its data
+    p.history = np.array([-1.0])
+
 
 # Redo part of the example, but with a class which rejects duplicates 
 class NoDupOrderedDict(OrderedDict):
@@ -83,9 +610,16 @@ class OrderedMeta2(type):
   def __prepare__(cls, clsname, bases):
     return NoDupOrderedDict(clsname)
 
-class A(metaclass=OrderedMeta2):
-  def spam(self):
-    pass
+# this is suppose to crash the program (uncomment to see)
+# class A(metaclass=OrderedMeta2):
+#   def spam(self):
+#     pass
+#
+#   def spam(self):
+#     pass
 
-  def spam(self):
-    pass
+
+if __name__ == '__main__':
+  benchmark_records()
+  benchmark_csv()
+  benchmark_structure_array()
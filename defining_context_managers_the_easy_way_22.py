@@ -1,22 +1,221 @@
 # you want to implement new kinds of context manager for use with the "with"
 # statement
 
+import os
+import json
 import time
+import threading
+from collections import deque
 from contextlib import contextmanager
+from contextvars import ContextVar
+from timeit import Timer
+
+# Every timed block is a node in a tree of spans.  The node for a label is
+# looked up under the node of the enclosing block, so repeats of the same
+# label path (main;parse;tokenize) keep adding to the same node.  Each thread
+# gets its own tree, the block currently open is kept in a ContextVar.
+class Span:
+  __slots__ = ('label', 'parent', 'children', 'count', 'total_ns', 'child_ns')
+
+  def __init__(self, label, parent=None):
+    self.label = label
+    self.parent = parent
+    self.children = {}
+    self.count = 0
+    self.total_ns = 0
+    self.child_ns = 0
+
+  def child(self, label):
+    try:
+      return self.children[label]
+    except KeyError:
+      node = self.children[label] = Span(label, self)
+      return node
+
+  @property
+  def self_ns(self):
+    '''time spent in this block but not in any block nested inside of it'''
+    # children running side by side (asyncio tasks) can add up to more than
+    # their parent's wall time
+    return max(self.total_ns - self.child_ns, 0)
+
+  def walk(self, path=()):
+    '''yield (label path, span) for this span's descendants'''
+    for label, node in self.children.items():
+      node_path = path + (label,)
+      yield node_path, node
+      yield from node.walk(node_path)
+
+_roots = {}            # thread id -> root Span
+_events = {}           # thread id -> deque of trace events, when tracing
+_roots_lock = threading.Lock()
+_local = threading.local()
+_current = ContextVar('timethis_current', default=None)
+_tracing = None        # maxlen of the per thread event deques, None is off
+
+def _thread_root():
+  try:
+    return _local.root
+  except AttributeError:
+    ident = threading.get_ident()
+    with _roots_lock:
+      root = _local.root = _roots[ident] = Span(threading.current_thread().name)
+      if _tracing is not None:
+        _events[ident] = deque(maxlen=_tracing)
+    return root
+
+def set_tracing(maxlen=100000):
+  '''keep the last maxlen spans of every thread for chrome_trace, None stops'''
+  global _tracing
+  with _roots_lock:
+    _tracing = maxlen
+    _events.clear()
+    if maxlen is not None:
+      for ident in _roots:
+        _events[ident] = deque(maxlen=maxlen)
+
+def reset():
+  '''forget every span recorded so far, blocks open at the time are dropped'''
+  with _roots_lock:
+    for root in _roots.values():
+      root.children = {}
+    for events in _events.values():
+      events.clear()
+
+class TimeThis:
+  '''class based timethis, it doesn't pay for a generator on every entry'''
+  __slots__ = ('label', '_node', '_start', '_token')
+  clock = staticmethod(time.perf_counter_ns)
+
+  def __init__(self, label):
+    self.label = label
+
+  def __enter__(self):
+    parent = _current.get() or _thread_root()
+    self._node = parent.child(self.label)
+    self._token = _current.set(self._node)
+    self._start = self.clock()
+    return self
+
+  def __exit__(self, exc_type, exc_value, tb):
+    end = self.clock()
+    elapsed = end - self._start
+    node = self._node
+    node.count += 1
+    node.total_ns += elapsed
+    node.parent.child_ns += elapsed
+    _current.reset(self._token)
+    if _tracing is not None:
+      events = _events.get(threading.get_ident())
+      if events is not None:
+        events.append((self.label, self._start, elapsed))
+    return False
+
+  # async with TimeThis(label): works the same way.  The open block lives in a
+  # ContextVar and every asyncio task runs in its own copy of the context, so
+  # blocks in tasks running side by side nest under their own parents.  The
+  # time is wall clock time, it includes the time the task spent suspended.
+  async def __aenter__(self):
+    return self.__enter__()
+
+  async def __aexit__(self, exc_type, exc_value, tb):
+    return self.__exit__(exc_type, exc_value, tb)
 
 @contextmanager
 def timethis(label):
-  start = time.time()
-  try:
+  with TimeThis(label):
     yield
-  finally:
-    end = time.time()
-    print('{}: {}'.format(label, end-start))
 
-# Example use:
-with timethis('counting'):
-  n = 10000000
-  while n > 0:
-    n -= 1
+def _merged():
+  '''label path -> [count, total_ns, self_ns] summed over every thread'''
+  merged = {}
+  with _roots_lock:
+    roots = list(_roots.values())
+  for root in roots:
+    for path, node in root.walk():
+      totals = merged.setdefault(path, [0, 0, 0])
+      totals[0] += node.count
+      totals[1] += node.total_ns
+      totals[2] += node.self_ns
+  return merged
+
+def report():
+  '''the span tree as text: count, total and self time of each label path'''
+  lines = []
+  for path, (count, total_ns, self_ns) in sorted(_merged().items()):
+    lines.append('{}{:<{}} {:>8} calls {:>12.3f} ms total {:>12.3f} ms self'.format(
+      '  ' * (len(path) - 1), path[-1], 32 - 2 * (len(path) - 1), count,
+      total_ns / 1e6, self_ns / 1e6))
+  return '\n'.join(lines)
+
+def collapsed_stacks():
+  '''"a;b;c <self microseconds>" lines, the input format of flamegraph.pl'''
+  return '\n'.join(
+    '{} {}'.format(';'.join(path), self_ns // 1000)
+    for path, (count, total_ns, self_ns) in sorted(_merged().items())
+    if self_ns >= 1000)
+
+def chrome_trace():
+  '''the traced spans as Chrome trace-event JSON (chrome://tracing, perfetto)'''
+  pid = os.getpid()
+  trace = []
+  with _roots_lock:
+    events = {ident: list(spans) for ident, spans in _events.items()}
+  for ident, spans in events.items():
+    for label, start, elapsed in spans:
+      trace.append({'name': label, 'ph': 'X', 'pid': pid, 'tid': ident,
+        'ts': start / 1000, 'dur': elapsed / 1000})
+  return json.dumps({'traceEvents': trace, 'displayTimeUnit': 'ns'})
+
+def benchmark_entry_cost(number=200000, repeat=5):
+  '''per entry cost of the generator based timethis and the class'''
+  def generator_based():
+    with timethis('generator'):
+      pass
+
+  def class_based():
+    with TimeThis('class'):
+      pass
+
+  for name, f in (('@contextmanager', generator_based), ('TimeThis', class_based)):
+    cost = min(Timer(f).repeat(repeat, number)) / number * 1e9
+    print('{:16} {:8.1f} ns per with block'.format(name, cost))
+  reset()
+
+if __name__ == '__main__':
+  # Example use:
+  set_tracing()
+  with timethis('counting'):
+    n = 10000000
+    while n > 0:
+      n -= 1
+
+  for i in range(3):
+    with TimeThis('main'):
+      with TimeThis('parse'):
+        with TimeThis('tokenize'):
+          sum(range(100000))
+        sum(range(50000))
+      with TimeThis('evaluate'):
+        sum(range(200000))
+
+  import asyncio
+
+  async def request(i):
+    async with TimeThis('request'):
+      async with TimeThis('database'):
+        await asyncio.sleep(0.01 * i)
+      async with TimeThis('render'):
+        await asyncio.sleep(0.005)
+
+  async def serve():
+    async with TimeThis('serve'):
+      await asyncio.gather(*(request(i) for i in range(1, 4)))
 
+  asyncio.run(serve())
 
+  print(report())
+  print(collapsed_stacks())
+  print(chrome_trace()[:200])
+  reset()
+  benchmark_entry_cost()
@@ -3,7 +3,13 @@
 # arguments to see if they match a specified calling signature.
 
 from inspect import Signature, Parameter
+from timeit import Timer
+import sys
 import inspect
+import keyword
+import tracemalloc
+
+from signature_cache import from_names
 
 # Make a signature for a func(x, y=42, *, z=None)
 params = [ Parameter('x', Parameter.POSITIONAL_OR_KEYWORD),
@@ -31,9 +37,9 @@ line(); func(y=2, x=1)
 # line(); func(1, 2, 3, 4)
 
 def make_sig(*names):
-  params = [Parameter(name, Parameter.POSITIONAL_OR_KEYWORD) 
-    for name in names]
-  return Signature(params)
+  # the same as Signature([Parameter(name, Parameter.POSITIONAL_OR_KEYWORD)
+  # for name in names]), made once for each list of names (see signature_cache)
+  return from_names(names)
 
 class Structure:
   _signature_ = make_sig()
@@ -62,8 +68,7 @@ s1 = Stock('ACME', 100, 490.1)
 from inspect import Signature, Parameter
 
 def make_sig(*names):
-  parms = [Parameter(name, Parameter.POSITIONAL_OR_KEYWORD) for name in names]
-  return Signature(parms)
+  return from_names(names)
 
 # start experiment
 # trying to understand "make_sig(*clsdict.get('_fields', []))"
@@ -82,13 +87,48 @@ _dict_function(*_dict.get('_fields', []))
 print('here')
 # finished experiment
 
+# Binding a signature and calling setattr for every field costs a few
+# microseconds per instance, and each instance carries a __dict__.  So the
+# metaclass writes out a real __init__ with the fields as its parameters:
+#
+#   def __init__(self, name, shares, price):
+#     self.name = name
+#     self.shares = shares
+#     self.price = price
+#
+# which takes the same arguments and raises a TypeError for the same mistakes
+# (missing, extra or doubled arguments) as binding the signature did, and it
+# adds __slots__ for the fields.  A class which defines its own __init__ or
+# __slots__ keeps them, put '__dict__' in __slots__ to be able to set other
+# attributes.
+def _make_init(clsname, fields):
+  source = 'def __init__(self{}):\n{}\n'.format(
+    ''.join(', ' + name for name in fields),
+    '\n'.join('  self.{0} = {0}'.format(name) for name in fields) or '  pass')
+  namespace = {}
+  exec(source, namespace)
+  init = namespace['__init__']
+  init.__qualname__ = clsname + '.__init__'
+  return init
+
 class StructureMeta(type):
   def __new__(cls, clsname, bases, clsdict):
-    clsdict['__signature__'] = make_sig(*clsdict.get('_fields', []))
+    fields = clsdict.get('_fields', [])
+    clsdict['__signature__'] = make_sig(*fields)
+    if '_fields' in clsdict and all(
+        name.isidentifier() and not keyword.iskeyword(name) for name in fields):
+      if '__slots__' not in clsdict:
+        inherited = {name for base in bases for klass in base.__mro__
+          for name in getattr(klass, '__slots__', ())}
+        clsdict['__slots__'] = tuple(name for name in fields
+          if name not in inherited)
+      if '__init__' not in clsdict:
+        clsdict['__init__'] = _make_init(clsname, fields)
     return super().__new__(cls, clsname, bases, clsdict)
 
 class Structure(metaclass=StructureMeta):
   _fields = []
+  __slots__ = ()
   def __init__(self, *args, **kwargs):
     bound_values = self.__signature__.bind(*args, **kwargs)
     for name, value in bound_values.arguments.items():
@@ -106,3 +146,30 @@ class Point(Structure):
 print(inspect.signature(Stock))
 
 google_stock = Stock('GOOG', 120, 123.00)
+
+def benchmark_construction(count=100000, repeat=5):
+  '''instances per second and bytes per instance, the generated __init__ and
+  __slots__ against binding the signature into a __dict__'''
+  class BoundStock(Structure):
+    _fields = ['name', 'shares', 'price']
+    __slots__ = ('__dict__',)
+    __init__ = Structure.__init__
+
+  results = {}
+  for label, cls in (('bind', BoundStock), ('generated', Stock)):
+    rate = count / min(Timer(lambda: cls('GOOG', 100, 490.1)).repeat(repeat, count))
+    tracemalloc.start()
+    start = tracemalloc.get_traced_memory()[0]
+    keep = [cls('GOOG', 100, 490.1) for i in range(count)]
+    used = tracemalloc.get_traced_memory()[0] - start
+    tracemalloc.stop()
+    # not counting the list holding them
+    per_instance = (used - sys.getsizeof(keep)) / count
+    results[label] = rate, per_instance
+    print('{:10} {:12.0f} instances/s {:8.1f} bytes per instance'.format(
+      label, rate, per_instance))
+    del keep
+  return results
+
+if __name__ == '__main__':
+  benchmark_construction()
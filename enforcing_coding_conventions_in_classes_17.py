@@ -34,14 +34,23 @@ a = A()
 # definition of redefined methods to make sure they are the same calling
 # signature as the original method in the superclass
 
-from inspect import signature
+import time
+import random
+import inspect
 import logging
 
+# signatures of the methods being overridden are looked up again for every
+# subclass, signature_cache remembers them
+from signature_cache import signature, comparable, stats, clear
+
 # Without the following line, nothing will show up.
 # the basicConfig must be called before using the logger
 logging.basicConfig(level=logging.DEBUG)
 
 class MatchSignatureMeta(type):
+  _signature = staticmethod(signature)
+  _comparable = staticmethod(comparable)
+
   def __init__(self, clsname, bases, clsdict):
     super().__init__(clsname, bases, clsdict)
     # self is a class obj
@@ -52,9 +61,9 @@ class MatchSignatureMeta(type):
       # Get the previous definition (if any) and compare the signatures
       prev_dfn = getattr(sup, name, None)
       if prev_dfn:
-        prev_sig = signature(prev_dfn)
-        val_sig = signature(value)
-        if prev_sig != val_sig:
+        if self._comparable(prev_dfn) != self._comparable(value):
+          prev_sig = self._signature(prev_dfn)
+          val_sig = self._signature(value)
           logging.warning('Signature mismatch in %s. %s != %s',
             value.__qualname__, prev_sig, val_sig)
 
@@ -76,3 +85,36 @@ class B(A):
 
   def spam(self, x, z):
     pass
+
+def _hierarchy(meta, classes, methods=10, overrides=3, seed=0):
+  '''classes subclasses of a root with methods methods, each one a subclass of
+  a random earlier class overriding overrides of the methods'''
+  rng = random.Random(seed)
+  def method():
+    def m(self, x, y=1, *, z=None):
+      pass
+    return m
+  root = meta('Root', (), {'m{}'.format(i): method() for i in range(methods)})
+  made = [root]
+  for i in range(classes):
+    body = {'m{}'.format(j): method() for j in rng.sample(range(methods), overrides)}
+    made.append(meta('C{}'.format(i), (rng.choice(made),), body))
+  return made
+
+def benchmark_hierarchy(classes=5000):
+  '''time to define a 5000 class hierarchy under MatchSignatureMeta with and
+  without the shared signature cache'''
+  class UncachedMeta(MatchSignatureMeta):
+    _signature = _comparable = staticmethod(inspect.signature)
+
+  for label, meta in (('inspect.signature', UncachedMeta),
+      ('signature_cache', MatchSignatureMeta)):
+    clear()
+    start = time.perf_counter()
+    _hierarchy(meta, classes)
+    elapsed = time.perf_counter() - start
+    print('{:18} {:8.3f} s  {}'.format(label, elapsed,
+      stats() if meta is MatchSignatureMeta else ''))
+
+if __name__ == '__main__':
+  benchmark_hierarchy()
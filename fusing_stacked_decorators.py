@@ -0,0 +1,296 @@
+# Stacking @timethis, @logged and @optional_debug gives three nested wrapper
+# frames per call, and every one of them packs and unpacks *args, **kwargs.
+#
+# Here the decorators describe what they do before and after the call as
+# snippets of source code (hooks), and fuse() writes one wrapper function out of
+# all of the snippets.  The generated wrapper has the exact parameter list of the
+# wrapped function, so there is only one extra frame and no repacking:
+#
+#   @fuse(timethis(aggregate=True), logged(level=logging.INFO), optional_debug)
+#   def countdown(n):
+#     ...
+#
+# is the same as stacking the three decorators in that order, but it compiles
+# to something like:
+#
+#   def countdown(n, *, debug=False):
+#     _h0_start = _h0_clock()
+#     _h1_log(_h1_level, _h1_message)
+#     if debug:
+#       print('Calling', _h2_name)
+#     _result = _func(n)
+#     _h0_record(_h0_clock() - _h0_start)
+#     return _result
+
+import time
+import inspect
+import logging
+from functools import partial, update_wrapper
+from timeit import Timer
+
+import putting_a_wrapper_around_a_function_1 as timing
+import wrapper_with_arguments_6 as logging_recipe
+from wrapper_with_arguments_4 import watch
+import writing_decorators_that_add_args_to_wrapped_functions_11 as debugging
+
+class Hooks:
+  '''what one decorator contributes to a fused wrapper
+
+  before and after are lines of source, with {p} standing in for the prefix
+  that keeps the names of one decorator apart from another's.  namespace holds
+  the objects those lines refer to (without the prefix), keyword_only is a
+  list of inspect.Parameter objects the decorator adds to the signature, and
+  attributes are set on the fused wrapper (like the histogram of timethis).
+  If enabled is given the lines are only in the wrapper while enabled()
+  returns true (like logged when its level is off), see fuse.
+  '''
+  def __init__(self, before=(), after=(), namespace=None, keyword_only=(),
+      attributes=None, enabled=None):
+    self.before = list(before)
+    self.after = list(after)
+    self.namespace = namespace or {}
+    self.keyword_only = list(keyword_only)
+    self.attributes = attributes or {}
+    self.enabled = enabled
+
+_hook_factories = {}
+
+def fusable(decorator):
+  '''register the function which builds the Hooks of decorator'''
+  def register(factory):
+    _hook_factories[decorator] = factory
+    return factory
+  return register
+
+def _hooks_for(decorator, func):
+  # decorators with arguments, like logged(level=...), hand back a partial
+  keywords = {}
+  if isinstance(decorator, partial):
+    decorator, keywords = decorator.func, decorator.keywords
+  try:
+    factory = _hook_factories[decorator]
+  except KeyError:
+    raise TypeError('{!r} has no hooks registered, it can\'t be fused'.format(
+      decorator)) from None
+  return factory(func, **keywords)
+
+@fusable(timing.timethis)
+def _timethis_hooks(func, *, aggregate=False):
+  if not aggregate:
+    return Hooks(
+      before=['{p}start = {p}time()'],
+      after=['print({p}name, {p}time() - {p}start)'],
+      namespace={'time': time.time, 'name': func.__name__})
+  # Histogram.record inlined, as timethis(aggregate=True) does it; counts is
+  # looked up on the histogram every time, reset() replaces the list
+  histogram = timing.Histogram()
+  return Hooks(
+    before=['{p}start = {p}clock()'],
+    after=[
+      '{p}ns = {p}clock() - {p}start',
+      'if {p}ns < {p}linear:',
+      '  {p}histogram.counts[{p}ns] += 1',
+      'else:',
+      '  if {p}ns > {p}top:',
+      '    {p}ns = {p}top',
+      '  {p}shift = {p}ns.bit_length() - {p}sub_bits',
+      '  {p}histogram.counts[({p}shift << ({p}sub_bits - 1)) + ({p}ns >> {p}shift)] += 1',
+      'if {p}ns > {p}histogram.max_ns:',
+      '  {p}histogram.max_ns = {p}ns'],
+    namespace={'clock': time.perf_counter_ns, 'histogram': histogram,
+      'linear': 1 << timing._SUB_BITS,
+      'sub_bits': timing._SUB_BITS, 'top': timing._MAX_NS - 1},
+    attributes={'histogram': histogram})
+
+@fusable(logging_recipe.logged)
+def _logged_hooks(func, *, level=logging.DEBUG, name=None, message=None,
+    sink=None, capture=None, rate=None):
+  if capture is not None:
+    raise TypeError('logged(capture=...) wraps the call in a try, it can\'t be '
+      'fused')
+  log = logging.getLogger(name if name else func.__module__)
+  namespace = {'log': log, 'level': level,
+    'message': message if message else func.__name__}
+  if sink is not None:
+    namespace['emit'] = partial(sink.put, log, level)
+  else:
+    namespace['emit'] = partial(log.log, level)
+  # like the logged wrappers, the lines are left out while the level is off
+  enabled = lambda: log.isEnabledFor(level)
+  if rate is None:
+    return Hooks(before=['{p}emit({p}message)'], namespace=namespace,
+      enabled=enabled)
+  limiter = logging_recipe.RateLimiter(*rate)
+  namespace.update(check=limiter.check, folded=limiter.folded)
+  return Hooks(before=[
+    '{p}suppressed = {p}check()',
+    'if {p}suppressed == 0:',
+    '  {p}emit({p}message)',
+    'elif {p}suppressed > 0:',
+    '  {p}emit({p}folded({p}message, {p}suppressed))'],
+    namespace=namespace, enabled=enabled)
+
+@fusable(debugging.optional_debug)
+def _optional_debug_hooks(func):
+  return Hooks(
+    before=['if debug:', '  print(\'Calling\', {p}name)'],
+    namespace={'name': func.__name__},
+    keyword_only=[inspect.Parameter('debug', inspect.Parameter.KEYWORD_ONLY,
+      default=False)])
+
+def _render(parameters):
+  '''the text of a parameter list, defaults are looked up in the namespace'''
+  text, call, namespace = [], [], {}
+  kind = inspect.Parameter
+  star_written = False
+  for param in parameters:
+    if param.kind == kind.KEYWORD_ONLY and not star_written:
+      text.append('*')
+      star_written = True
+    if param.kind == kind.VAR_POSITIONAL:
+      text.append('*' + param.name)
+      call.append('*' + param.name)
+      star_written = True
+    elif param.kind == kind.VAR_KEYWORD:
+      text.append('**' + param.name)
+      call.append('**' + param.name)
+    else:
+      item = param.name
+      if param.default is not kind.empty:
+        namespace['_default_' + param.name] = param.default
+        item += '=_default_' + param.name
+      text.append(item)
+      if param.kind == kind.KEYWORD_ONLY:
+        call.append('{0}={0}'.format(param.name))
+      else:
+        call.append(param.name)
+    if param.kind == kind.POSITIONAL_ONLY and (
+        param is parameters[-1] or parameters[parameters.index(param) + 1].kind
+        != kind.POSITIONAL_ONLY):
+      text.append('/')
+  return ', '.join(text), ', '.join(call), namespace
+
+def fuse(*decorators):
+  '''decorate with all of decorators (outermost first) in a single wrapper'''
+  def decorate(func):
+    if timing.suspendable(func):
+      # the hooks run around the call, which for these only builds the
+      # coroutine or generator; stack the decorators instead
+      raise TypeError('{} is a coroutine, async generator or generator '
+        'function, it can\'t be fused'.format(func.__qualname__))
+    hooks = [_hooks_for(d, func) for d in decorators]
+    sig = inspect.signature(func)
+    own = list(sig.parameters.values())
+    added = [p for h in hooks for p in h.keyword_only]
+    for param in own:
+      if param.name.startswith(('_h', '_default_')) or param.name in (
+          '_func', '_result') or param.name in {p.name for p in added}:
+        raise TypeError('parameter {} of {} clashes with a fused wrapper name'
+          .format(param.name, func.__qualname__))
+    # the added keyword only parameters go before any **kwargs
+    if own and own[-1].kind == inspect.Parameter.VAR_KEYWORD:
+      parameters = own[:-1] + added + own[-1:]
+    else:
+      parameters = own + added
+    params_text, _, namespace = _render(parameters)
+    _, call_text, _ = _render(own)
+    for index, hook in enumerate(hooks):
+      for key, value in hook.namespace.items():
+        namespace['_h{}_{}'.format(index, key)] = value
+    namespace['_func'] = func
+    name = func.__name__ if func.__name__.isidentifier() else 'fused'
+
+    def compile_wrapper(active):
+      '''the wrapper with the lines of the hooks in active'''
+      lines = []
+      for index in active:
+        lines += [line.format(p='_h{}_'.format(index)) for line in hooks[index].before]
+      lines.append('_result = _func({})'.format(call_text))
+      for index in reversed(active):
+        lines += [line.format(p='_h{}_'.format(index)) for line in hooks[index].after]
+      lines.append('return _result')
+      source = 'def {}({}):\n{}\n'.format(
+        name, params_text, '\n'.join('  ' + line for line in lines))
+      exec(source, namespace)
+      wrapper = namespace[name]
+      if hasattr(wrapper.__code__, 'co_qualname'):
+        # named after func by the def above, see unwrapping_meta_3.layer_name
+        wrapper.__code__ = wrapper.__code__.replace(
+          co_qualname='fuse.<locals>.wrapper')
+      return wrapper, source
+
+    everything = list(range(len(hooks)))
+    wrapper, source = compile_wrapper(everything)
+    wrapper.__fused_source__ = source
+    update_wrapper(wrapper, func)
+
+    if any(hook.enabled is not None for hook in hooks):
+      # hooks that can be switched off (logged at a disabled level) are left
+      # out of the wrapper while they are off: every variant is compiled into
+      # the same namespace, so one can be swapped for another through
+      # wrapper.__code__ (see wrapper_with_arguments_4.specialize), and it is
+      # swapped again by refresh_logged()
+      variants = {tuple(everything): (wrapper.__code__, source)}
+
+      def respecialize():
+        active = tuple(index for index, hook in enumerate(hooks)
+          if hook.enabled is None or hook.enabled())
+        if active not in variants:
+          variant, variant_source = compile_wrapper(list(active))
+          variants[active] = (variant.__code__, variant_source)
+        wrapper.__code__, wrapper.__fused_source__ = variants[active]
+
+      wrapper.respecialize = respecialize
+      watch(wrapper)
+    if added:
+      wrapper.__signature__ = sig.replace(parameters=parameters)
+    for hook in hooks:
+      for key, value in hook.attributes.items():
+        setattr(wrapper, key, value)
+    return wrapper
+  return decorate
+
+def benchmark_fused(number=200000, repeat=5, level=logging.WARNING):
+  '''naively stacked decorators against the same decorators fused, logging
+  at DEBUG to a NullHandler while the logger's level is level (the default
+  leaves logging off, so log.log doesn't swamp the wrappers)'''
+  log = logging.getLogger('fused')
+  log.propagate = False
+  if not log.handlers:
+    log.addHandler(logging.NullHandler())
+  log.setLevel(level)
+
+  def spam(a, b, c=3):
+    return a + b + c
+
+  stacked = timing.timethis(aggregate=True)(
+    logging_recipe.logged(name='fused', level=logging.DEBUG)(
+      debugging.optional_debug(spam)))
+  fused = fuse(timing.timethis(aggregate=True),
+    logging_recipe.logged(name='fused', level=logging.DEBUG),
+    debugging.optional_debug)(spam)
+
+  results = {}
+  for label, f in (('bare', spam), ('stacked', stacked), ('fused', fused)):
+    results[label] = min(Timer(lambda: f(1, 2)).repeat(repeat, number)) / number * 1e9
+    print('{:8} {:8.1f} ns'.format(label, results[label]))
+  print('speedup of fused over stacked ({}): {:.2f}x'.format(
+    'logging on' if log.isEnabledFor(logging.DEBUG) else 'logging off',
+    (results['stacked'] - results['bare']) / (results['fused'] - results['bare'])))
+  return results
+
+if __name__ == '__main__':
+  @fuse(timing.timethis, logging_recipe.logged(level=logging.INFO),
+    debugging.optional_debug)
+  def countdown(n:int, step:int=1):
+    '''counts down'''
+    while n > 0:
+      n -= step
+
+  print(countdown.__fused_source__)
+  countdown(100000)
+  countdown(100000, debug=True)
+  print(countdown.__name__, countdown.__doc__, inspect.signature(countdown))
+  print(countdown.__wrapped__)
+  benchmark_fused()
+  benchmark_fused(level=logging.DEBUG)
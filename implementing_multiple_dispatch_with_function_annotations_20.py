@@ -11,46 +11,279 @@
 # s.bar(2, 3)    # => Bar 1: 2 3
 # s.bar('hello') # => Bar 2: hello 0
 
+import abc
 import inspect
 import types
+import random
+import warnings
+from timeit import Timer
+from itertools import islice, starmap
+from collections import deque
+from functools import singledispatchmethod
+
+from signature_cache import derived, signature
+
+# A call is matched against every registered type signature of the same
+# length: a signature matches if each argument is an instance of the type in
+# its place (subclasses and ABCs included, so a bool is taken for an int).  Of
+# the matches the most specific is called, where for each argument a type is
+# as specific as its place in the argument's C3 MRO (type(arg).__mro__): its
+# own class is 0, the next base is 1 and so on.  A signature is more specific
+# than another if none of its arguments is further away and at least one is
+# closer; if no match is more specific than all of the others the call is
+# ambiguous.
+#
+# Working that out is slow, so the method it picks is remembered under the
+# tuple of the argument types (the type of self included, it's the cheapest
+# way to make the key) and once a type tuple has been seen a call costs one
+# dict lookup.  Registering a method, or registering a class with an ABC that
+# is used in an annotation, forgets what was remembered.
+class AmbiguityWarning(UserWarning):
+  '''two registered signatures can both be the best match for some call'''
+
+def _distance(cls, annotation):
+  '''how far annotation is from cls in cls's MRO, None if it doesn't match'''
+  mro = cls.__mro__
+  try:
+    return mro.index(annotation)
+  except ValueError:
+    pass
+  if not issubclass(cls, annotation):
+    return None
+  # a virtual base class (an ABC) goes just after the last class of the MRO
+  # which is still a subclass of it: for a bool numbers.Integral comes after
+  # int and before object
+  return max(n for n, base in enumerate(mro) if issubclass(base, annotation)) + 0.5
+
+def _more_specific(a, b):
+  return all(x <= y for x, y in zip(a, b)) and a != b
 
 class MultiMethod:
   '''represents a signal multimethod'''
   def __init__(self, name):
     self._methods = {}
+    self._cache = {}
+    self._keyword_cache = {}
+    # the signature each key in _cache was resolved to (see dispatch_many)
+    self._signatures = {}
+    self._batches = {}
+    self._abc_token = None
     self.__name__ = name
   def register(self, method):
     '''register a new method as a multimethod'''
-    sig = inspect.signature(method)
-    # Build a type signature from the method's annotation
-    types = []
-    for name, param in sig.parameters.items():
-      if name == 'self':
+    # the type signatures are worked out once per method (see signature_cache)
+    for types in derived(method, 'multimethod_types', _type_signatures):
+      self._warn_if_ambiguous(types, method)
+      self._methods[types] = method
+      if self._abc_token is None and any(isinstance(t, abc.ABCMeta) for t in types):
+        self._abc_token = abc.get_cache_token()
+    self._cache.clear()
+    self._keyword_cache.clear()
+    self._signatures.clear()
+
+  def _warn_if_ambiguous(self, new, method):
+    '''warn if a call could match new and one of the registered signatures
+    without either of them being more specific'''
+    for types in self._methods:
+      if len(types) != len(new) or types == new:
+        continue
+      if all(issubclass(a, b) for a, b in zip(new, types)) or all(
+          issubclass(b, a) for a, b in zip(new, types)):
+        continue   # one of them is more specific
+      if not all(issubclass(a, b) or issubclass(b, a) for a, b in zip(new, types)):
+        continue   # no argument types are matched by both
+      meet = tuple(a if issubclass(a, b) else b for a, b in zip(new, types))
+      if meet not in self._methods:
+        warnings.warn('{}{} and {}{} are ambiguous for arguments of types {}, '
+          'register a method for {} to resolve it'.format(self.__name__,
+          _names(new), self.__name__, _names(types), _names(meet), _names(meet)),
+          AmbiguityWarning, stacklevel=4)
+
+  def _resolve(self, key):
+    '''the method for arguments of types key (the first is self's)'''
+    types = key[1:]
+    matches = []
+    for signature, method in self._methods.items():
+      if len(signature) != len(types):
         continue
-      if param.annotation is inspect.Parameter.empty:
-        raise TypeError(
-          'Argument {} must be anotated with a type'.format(name)
-        )
-      if not isinstance(param.annotation, type):
-        raise TypeError(
-          'Argument {} annotation must be a type'.format(name)
-        )
-      if param.default is not inspect.Parameter.empty:
-        self._methods[tuple(types)] = method
-      types.append(param.annotation)
-
-    self._methods[tuple(types)] = method
-
-  def __call__(self, *args):
+      distances = tuple(map(_distance, types, signature))
+      if None not in distances:
+        matches.append((distances, signature, method))
+    distances, signature, method = self._best(matches, _names(types))
+    self._signatures[key] = signature
+    self._cache[key] = method
+    return method
+
+  def _best(self, matches, called):
+    '''the most specific of matches, (distances, signature, method) tuples,
+    for a call described by called'''
+    if not matches:
+      raise TypeError('No matching method for {}{}, the candidates are {}'.format(
+        self.__name__, called, ', '.join(
+        self.__name__ + str(signature(method)) for method in self._candidates())))
+    best = [match for match in matches
+      if not any(_more_specific(other[0], match[0]) for other in matches)]
+    if len(best) > 1:
+      raise TypeError('Ambiguous call to {}{}, it could be any of {}'
+        .format(self.__name__, called, ', '.join(
+        self.__name__ + _names(signature) for d, signature, m in best)))
+    return best[0]
+
+  def _candidates(self):
+    '''the registered methods, in the order they were registered'''
+    return list(dict.fromkeys(self._methods.values()))
+
+  def _resolve_keywords(self, key, args, kwargs):
+    '''the method for a call with keyword arguments, each method's binder
+    (a function with the method's parameters, without the annotations) puts
+    the arguments in their places'''
+    matches = {}
+    for method in self._candidates():
+      binder, annotations = derived(method, 'multimethod_binder', _binder)
+      try:
+        values = binder(*args, **kwargs)
+      except TypeError:
+        continue
+      # arguments left to their defaults aren't checked
+      distances = tuple(0 if value is _missing else _distance(type(value), annotation)
+        for value, annotation in zip(values, annotations))
+      if None not in distances:
+        checked = tuple(annotation for value, annotation in zip(values, annotations)
+          if value is not _missing)
+        # a later method replaces an earlier one with the same signature, like
+        # it does in self._methods
+        matches[checked] = (distances, checked, method)
+    matches = list(matches.values())
+    called = '({})'.format(', '.join([t.__name__ for t in key[0][1:]] + [
+      '{}={}'.format(name, t.__name__) for name, t in zip(key[1], key[2])]))
+    method = self._keyword_cache[key] = self._best(matches, called)[2]
+    return method
+
+  def _check_abc_token(self):
+    if self._abc_token != abc.get_cache_token():
+      # an ABC had a class registered with it, that can change what matches
+      self._abc_token = abc.get_cache_token()
+      self._cache.clear()
+      self._keyword_cache.clear()
+      self._signatures.clear()
+
+  def _call_with_keywords(self, args, kwargs):
+    key = (tuple(map(type, args)), tuple(kwargs), tuple(map(type, kwargs.values())))
+    try:
+      method = self._keyword_cache[key]
+    except KeyError:
+      method = self._resolve_keywords(key, args, kwargs)
+    return method(*args, **kwargs)
+
+  def __call__(self, *args, **kwargs):
     '''
     call a method based on type signature of the arguments
     '''
-    types = tuple(type(arg) for arg in args[1:])
-    method = self._methods.get(types, None)
-    if method:
-      return method(*args)
+    if self._abc_token is not None:
+      self._check_abc_token()
+    if kwargs:
+      return self._call_with_keywords(args, kwargs)
+    key = tuple(map(type, args))
+    try:
+      method = self._cache[key]
+    except KeyError:
+      method = self._resolve(key)
+    return method(*args)
+
+  def register_batch(self, types, batch):
+    '''register batch(calls) as the batch version of the method registered
+    for types: it is given a list of argument tuples (self included) that
+    method would be called with and returns a list of the results
+
+    The batch is kept under types, not under the method: a method with
+    defaults is registered for several numbers of arguments, and its batch
+    for one of them is only given the calls which resolve to that one.'''
+    types = tuple(types)
+    if types not in self._methods:
+      raise TypeError('{} has no method for types {} to batch'.format(
+        self.__name__, _names(types)))
+    self._batches[types] = batch
+
+  def dispatch_many(self, calls, chunk_size=10000):
+    '''yield self(*args) for each args tuple in calls, in order
+
+    calls are read chunk_size at a time, each chunk is split up by the
+    signature the arguments resolve to and the method of each signature is
+    called on its part in one go: with the batch version registered for the
+    signature if there is one, otherwise with starmap.
+    '''
+    calls = iter(calls)
+    signatures, resolve = self._signatures, self._resolve
+    while True:
+      chunk = list(islice(calls, chunk_size))
+      if not chunk:
+        return
+      if self._abc_token is not None:
+        self._check_abc_token()
+      # group by the types of the arguments first and then by the signature
+      # each group of types resolves to
+      by_signature = {}
+      for key, indices in _group_by_types(chunk).items():
+        if key not in signatures:
+          resolve(key)
+        signature = signatures[key]
+        if signature in by_signature:
+          by_signature[signature] += indices
+        else:
+          by_signature[signature] = list(indices)
+      if len(by_signature) == 1:
+        # nothing to split up or put back together
+        (signature,) = by_signature
+        yield from self._call_group(signature, chunk)
+        continue
+      results = [None] * len(chunk)
+      for signature, indices in by_signature.items():
+        values = self._call_group(signature, list(map(chunk.__getitem__, indices)))
+        # put the results back in the order of the calls
+        deque(map(results.__setitem__, indices, values), maxlen=0)
+      yield from results
+
+  def _call_group(self, signature, group_calls):
+    '''the results of calling the method for signature with each of
+    group_calls'''
+    batch = self._batches.get(signature)
+    if batch is None:
+      return list(starmap(self._methods[signature], group_calls))
+    values = list(batch(group_calls))
+    if len(values) != len(group_calls):
+      raise ValueError('batch {} returned {} results for {} calls'.format(
+        batch.__qualname__, len(values), len(group_calls)))
+    return values
+
+  def compile(self, qualname=None):
+    '''a function doing what __call__ does, to put in a class in place of the
+    MultiMethod: a function is a method without a __get__ written in Python,
+    and calling it skips the MethodType and the __call__ lookup'''
+    namespace = {'_mm': self, '_cache': self._cache, '_map': map, '_type': type,
+      '_tuple': tuple}
+    # the key is spelled out for each number of arguments registered so far,
+    # (_type(a0), _type(a1), _type(a2)) is about four times quicker to make
+    # than _tuple(_map(_type, args)), which is left for any other number
+    keys = []
+    for count in sorted({len(types) + 1 for types in self._methods}, reverse=True):
+      names = ['a{}'.format(n) for n in range(count)]
+      keys += [
+        '  {} n == {}:'.format('elif' if keys else 'if', count),
+        '    {}, = args'.format(', '.join(names)),
+        '    key = ({},)'.format(', '.join('_type({})'.format(a) for a in names))]
+    if keys:
+      keys = ['  n = len(args)'] + keys + ['  else:',
+        '    key = _tuple(_map(_type, args))']
     else:
-      raise TypeError('No matching method for types {}'.format(types))
+      keys = ['  key = _tuple(_map(_type, args))']
+    source = _DISPATCHER.format(name=self.__name__, key='\n'.join(keys))
+    exec(source, namespace)
+    function = namespace[self.__name__]
+    function.__dispatch_source__ = source
+    function.__qualname__ = qualname or self.__name__
+    function.__multimethod__ = self
+    function.dispatch_many = self.dispatch_many
+    return function
 
   def __get__(self, instance, cls):
     '''
@@ -61,12 +294,144 @@ class MultiMethod:
     else:
       return self
 
+def _group_by_types(chunk):
+  '''{tuple of argument types: indices of the calls in chunk with them}'''
+  if len(set(map(len, chunk))) != 1:
+    groups = {}
+    for index, args in enumerate(chunk):
+      key = tuple(map(type, args))
+      try:
+        groups[key].append(index)
+      except KeyError:
+        groups[key] = [index]
+    return groups
+  # all of the calls have the same number of arguments: get the types a
+  # column at a time, and only group on the columns where they differ (most
+  # of the time that's one, the type of self doesn't change)
+  columns = [list(map(type, column)) for column in zip(*chunk)]
+  template = [column[0] for column in columns]
+  varying = [n for n, column in enumerate(columns) if len(set(column)) > 1]
+  if not varying:
+    return {tuple(template): range(len(chunk))}
+  if len(varying) == 1:
+    partial_keys = columns[varying[0]]
+  else:
+    partial_keys = list(zip(*[columns[n] for n in varying]))
+  partial_groups = {}
+  for index, partial_key in enumerate(partial_keys):
+    try:
+      partial_groups[partial_key].append(index)
+    except KeyError:
+      partial_groups[partial_key] = [index]
+  groups = {}
+  for partial_key, indices in partial_groups.items():
+    if len(varying) == 1:
+      partial_key = (partial_key,)
+    for n, t in zip(varying, partial_key):
+      template[n] = t
+    groups[tuple(template)] = indices
+  return groups
+
+# _cache is the MultiMethod's own dict, which register() clears in place.
+# Keyword arguments and ABC annotations take the MultiMethod's own __call__.
+_DISPATCHER = '''
+def {name}(*args, **kwargs):
+  if kwargs or _mm._abc_token is not None:
+    return _mm(*args, **kwargs)
+{key}
+  try:
+    method = _cache[key]
+  except KeyError:
+    method = _mm._resolve(key)
+  return method(*args)
+'''
+
+def _names(types):
+  return '({})'.format(', '.join(t.__name__ for t in types))
+
+class _Missing:
+  def __repr__(self):
+    return '<missing>'
+
+_missing = _Missing()
+
+def _binder(sig):
+  '''(binder, annotations): binder takes the arguments of a method with
+  signature sig and returns the values of its annotated parameters, in order,
+  with _missing for those left to their defaults'''
+  kind = inspect.Parameter
+  parameters, names, annotations = [], [], []
+  star_written = False
+  params = list(sig.parameters.values())
+  for index, param in enumerate(params):
+    name = param.name
+    if param.kind == kind.KEYWORD_ONLY and not star_written:
+      parameters.append('*')
+      star_written = True
+    if param.kind == kind.VAR_POSITIONAL:
+      parameters.append('*' + name)
+      star_written = True
+    elif param.kind == kind.VAR_KEYWORD:
+      parameters.append('**' + name)
+    else:
+      parameters.append(name if param.default is kind.empty else name + '=_mm_missing')
+    if param.kind == kind.POSITIONAL_ONLY and (index + 1 == len(params)
+        or params[index + 1].kind != kind.POSITIONAL_ONLY):
+      parameters.append('/')
+    if name != 'self':
+      names.append(name)
+      annotations.append(param.annotation)
+  namespace = {'_mm_missing': _missing}
+  exec('def binder({}):\n  return ({})\n'.format(', '.join(parameters),
+    ''.join(name + ', ' for name in names)), namespace)
+  return namespace['binder'], tuple(annotations)
+
+def _type_signatures(sig):
+  '''the type tuples a method with signature sig can be called with'''
+  # Build a type signature from the method's annotation
+  signatures = []
+  types = []
+  for name, param in sig.parameters.items():
+    if name == 'self':
+      continue
+    if param.annotation is inspect.Parameter.empty:
+      raise TypeError(
+        'Argument {} must be anotated with a type'.format(name)
+      )
+    if not isinstance(param.annotation, type):
+      raise TypeError(
+        'Argument {} annotation must be a type'.format(name)
+      )
+    if param.default is not inspect.Parameter.empty:
+      signatures.append(tuple(types))
+    types.append(param.annotation)
+  signatures.append(tuple(types))
+  return signatures
+
+def batch(*types):
+  '''mark a function in a MultipleMeta class body as the batch version (see
+  MultiMethod.register_batch) of the method of the same name for types'''
+  def decorate(function):
+    function.__batch_types__ = types
+    return function
+  return decorate
+
 class MultiDict(dict):
   '''
   special dictionary to build multimethods in a metaclass
   '''
   def __setitem__(self, key, value):
-    if key in self:
+    if hasattr(value, '__batch_types__'):
+      current_value = self.get(key)
+      if current_value is None:
+        raise TypeError('the batch {} comes before any method called {}'.format(
+          value.__qualname__, key))
+      if not isinstance(current_value, MultiMethod):
+        current_value = MultiMethod(key)
+        current_value.register(self[key])
+        super().__setitem__(key, current_value)
+      current_value.register_batch(value.__batch_types__, value)
+    elif key in self:
       # If key alread exists, it must be a multimethod or callable
       current_value = self[key]
       if isinstance(current_value, MultiMethod):
@@ -84,7 +449,12 @@ class MultipleMeta(type):
   Metaclass that allows multiple dispatch of methods
   '''
   def __new__(cls, clsname, bases, clsdict):
-    return type.__new__(cls, clsname, bases, dict(clsdict))
+    clsdict = dict(clsdict)
+    for name, value in clsdict.items():
+      if isinstance(value, MultiMethod):
+        clsdict[name] = value.compile('{}.{}'.format(
+          clsdict.get('__qualname__', clsname), name))
+    return type.__new__(cls, clsname, bases, clsdict)
 
   @classmethod
   def __prepare__(cls, clsname, bases):
@@ -117,3 +487,120 @@ s.bar('hello')
 d = Date(2012, 12, 21)
 e = Date()
 print(e.year)
+
+# bool is a subclass of int, and numbers.Integral is an ABC of both
+import numbers
+class Number(metaclass=MultipleMeta):
+  def describe(self, x:numbers.Integral):
+    return 'integral'
+
+  def describe(self, x:int):
+    return 'int'
+
+  def describe(self, x:object):
+    return 'object'
+
+n = Number()
+print(n.describe(True), n.describe(1), n.describe(1.5))
+
+def benchmark_dispatch(number=200000, repeat=5):
+  '''warm multimethod dispatch against functools.singledispatchmethod'''
+  class Multi(metaclass=MultipleMeta):
+    def bar(self, x:int):
+      return x
+
+    def bar(self, x:str):
+      return x
+
+  class Single:
+    @singledispatchmethod
+    def bar(self, x):
+      raise NotImplementedError
+
+    @bar.register
+    def _(self, x:int):
+      return x
+
+    @bar.register
+    def _(self, x:str):
+      return x
+
+  multi, single = Multi(), Single()
+  for label, f in (('MultiMethod', multi.bar), ('singledispatchmethod', single.bar)):
+    for argument in (1, True, 'a'):
+      cost = min(Timer(lambda: f(argument)).repeat(repeat, number)) / number * 1e9
+      print('{:22} {:6} {:8.1f} ns'.format(label, type(argument).__name__, cost))
+
+def benchmark_overloads(number=200000, repeat=5):
+  '''Spam.bar and Date.__init__ through the MultiMethod descriptor (how
+  MultipleMeta classes used to call it) and through the compiled function'''
+  class Quiet(metaclass=MultipleMeta):
+    def bar(self, x:int, y:int):
+      return x + y
+
+    def bar(self, s:str, n:int = 0):
+      return s
+
+  # the same multimethods, left as MultiMethod descriptors (set after the
+  # class is made, or MultipleMeta would compile them)
+  Descriptor = type('Descriptor', (Quiet,), {})
+  Descriptor.bar = Quiet.bar.__multimethod__
+  DescriptorDate = type('DescriptorDate', (Date,), {})
+  DescriptorDate.__init__ = Date.__init__.__multimethod__
+
+  calls = [
+    ('bar(2, 3)', lambda spam: spam.bar(2, 3)),
+    ('bar(\'hello\')', lambda spam: spam.bar('hello')),
+    ('bar(\'hello\', n=1)', lambda spam: spam.bar('hello', n=1)),
+  ]
+  for label, call in calls:
+    for kind, spam in (('MultiMethod', Descriptor()), ('compiled', Quiet())):
+      cost = min(Timer(lambda: call(spam)).repeat(repeat, number)) / number * 1e9
+      print('{:22} {:12} {:8.1f} ns'.format(label, kind, cost))
+  for kind, cls in (('MultiMethod', DescriptorDate), ('compiled', Date)):
+    cost = min(Timer(lambda: cls(2012, 12, 21)).repeat(repeat, number)) / number * 1e9
+    print('{:22} {:12} {:8.1f} ns'.format('Date(2012, 12, 21)', kind, cost))
+
+def benchmark_dispatch_many(count=10**6):
+  '''count calls with a random mix of int and str arguments, one call at a
+  time and through dispatch_many with and without a batch version'''
+  class Plain(metaclass=MultipleMeta):
+    def double(self, x:int):
+      return x * 2
+
+    def double(self, s:str):
+      return s + s
+
+  class Batched(Plain):
+    def double(self, x:int):
+      return x * 2
+
+    def double(self, s:str):
+      return s + s
+
+    @batch(int)
+    def double(calls):
+      return [x * 2 for self, x in calls]
+
+    @batch(str)
+    def double(calls):
+      return [s + s for self, s in calls]
+
+  rng = random.Random(0)
+  items = [rng.choice((1, 'a')) for i in range(count)]
+  plain, batched = Plain(), Batched()
+  cases = [
+    ('one call at a time', lambda: [plain.double(x) for x in items]),
+    ('dispatch_many', lambda: list(Plain.double.dispatch_many(
+      (plain, x) for x in items))),
+    ('dispatch_many (batch)', lambda: list(Batched.double.dispatch_many(
+      (batched, x) for x in items))),
+  ]
+  for label, run in cases:
+    elapsed = min(Timer(run).repeat(3, 1))
+    print('{:22} {:8.1f} ns per call'.format(label, elapsed / count * 1e9))
+
+if __name__ == '__main__':
+  benchmark_dispatch()
+  benchmark_overloads()
+  benchmark_dispatch_many()
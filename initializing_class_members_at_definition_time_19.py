@@ -1,11 +1,18 @@
 # You want ot initialize parts of the class definition once at the time a class
 # is defined, not when instances are created.
 
+import os
+import mmap
+import time
+import struct
+import random
 import operator
+import tempfile
+import itertools
+from functools import partial
 
 class StructTupleMeta(type):
   def __init__(cls, *args, **kwargs):
-    print('init in StructTupleMeta')
     super().__init__(*args, **kwargs)
     for n, name in enumerate(cls._fields):
       # it's a tuple, we are creating the ability to reach in
@@ -34,19 +41,169 @@ class StructTupleMeta(type):
       # what I don't understand is how the operator.itemgetter(n) can access the
       # inner part of the tuple. (the obj)
       setattr(cls, name, property(operator.itemgetter(n)))
+    if cls._formats is not None:
+      _compile_struct(cls)
+
+# A class can declare a struct format for each field, _formats = ['8s', 'i',
+# 'd'], and the metaclass compiles them into one struct.Struct (little endian,
+# standard sizes, no padding; set _byteorder to change that).  The class then
+# gets:
+#
+#   record.to_bytes()                   # the packed record
+#   Stock.from_bytes(buffer, offset=0)  # a record unpacked from any buffer
+#   Stock.iter_from_buffer(buffer)      # an iterator of every record in buffer
+#
+# Nothing is copied out of the buffer but the field values themselves, so
+# iter_from_buffer over a memoryview or an mmap reads records straight out of
+# the mapped pages.  's' fields are str on the Python side, encoded with
+# _encoding and padded with NULs (the NULs are stripped again when unpacking).
+def _compile_struct(cls):
+  formats = list(cls._formats)
+  if len(formats) != len(cls._fields):
+    raise TypeError('{} has {} fields but {} formats'.format(
+      cls.__name__, len(cls._fields), len(formats)))
+  packer = struct.Struct(cls._byteorder + ''.join(formats))
+  strings = [n for n, fmt in enumerate(formats) if fmt.endswith('s')]
+  namespace = {'_new': tuple.__new__, '_pack': packer.pack,
+    '_unpack_from': packer.unpack_from, '_encoding': cls._encoding}
+  values = ['_v[{}]'.format(n) for n in range(len(formats))]
+  fields = ['self[{}]'.format(n) for n in range(len(formats))]
+  # struct.pack cuts a string down to its width without a word, which loses
+  # data and can split a multi-byte character, so to_bytes checks the width
+  checks = []
+  for n in strings:
+    width = int(formats[n][:-1] or 1)
+    values[n] = "_v[{}].rstrip(b'\\0').decode(_encoding)".format(n)
+    fields[n] = '_s{}'.format(n)
+    checks += [
+      '  _s{} = self[{}].encode(_encoding)'.format(n, n),
+      '  if len(_s{}) > {}:'.format(n, width),
+      '    raise ValueError({!r}.format(len(_s{})))'.format(
+        '{}.{} is {{}} bytes encoded, more than its {} bytes'.format(
+        cls.__name__, cls._fields[n], width), n)]
+  # the conversions are written out per field, with no 's' fields they go away
+  # and unpacked tuples become records with no Python code run per record
+  source = [
+    'def _from_values(cls, _v):',
+    '  return _new(cls, ({},))'.format(', '.join(values)),
+    'def from_bytes(cls, buffer, offset=0):',
+    '  return _from_values(cls, _unpack_from(buffer, offset))',
+    'def to_bytes(self):',
+  ] + checks + [
+    '  return _pack({})'.format(', '.join(fields)),
+  ]
+  if not strings:
+    source[1] = '  return _new(cls, _v)'
+  exec('\n'.join(source), namespace)
+  cls._struct = packer
+  cls._from_values = classmethod(namespace['_from_values'])
+  cls.from_bytes = classmethod(namespace['from_bytes'])
+  cls.to_bytes = namespace['to_bytes']
+  for name in ('_from_values', 'from_bytes', 'to_bytes'):
+    namespace[name].__qualname__ = '{}.{}'.format(cls.__qualname__, name)
+  cls._converts = bool(strings)
 
 # Make an immutable object which is set once at creation than can never be set
 # again.  (like a namedtuple)
 class StructTuple(tuple, metaclass=StructTupleMeta):
   _fields = []
+  _formats = None
+  _byteorder = '<'
+  _encoding = 'utf-8'
+  _struct = None
+
   # __new__ is called before an instance is created
   # "setting the tuple contents at definition time"
   def __new__(cls, *args):
-    print('new in StructTuple')
     if len(args) != len(cls._fields):
       raise ValueError('{} arguments required'.format(len(cls._fields)))
     return super().__new__(cls, args)
 
+  @classmethod
+  def _packer(cls):
+    if cls._struct is None:
+      raise TypeError('{} has no _formats'.format(cls.__name__))
+    return cls._struct
+
+  # replaced by the metaclass in classes with _formats
+  def to_bytes(self):
+    raise TypeError('{} has no _formats'.format(type(self).__name__))
+
+  @classmethod
+  def from_bytes(cls, buffer, offset=0):
+    raise TypeError('{} has no _formats'.format(cls.__name__))
+
+  @classmethod
+  def iter_from_buffer(cls, buffer):
+    '''the records packed back to back in buffer (its length has to be a
+    multiple of the record size)'''
+    records = cls._packer().iter_unpack(buffer)
+    if cls._converts:
+      return map(cls._from_values, records)
+    return map(partial(tuple.__new__, cls), records)
+
+  @classmethod
+  def write_records(cls, path, records, chunk_size=10000):
+    '''write records to path, packed back to back, for RecordFile to read'''
+    cls._packer()
+    records = iter(records)
+    with open(path, 'wb') as fp:
+      while True:
+        chunk = b''.join(map(cls.to_bytes, itertools.islice(records, chunk_size)))
+        if not chunk:
+          break
+        fp.write(chunk)
+
+class RecordFile:
+  '''the records of a file written by write_records, a record is only read
+  (from the mapped pages) when it is asked for'''
+  def __init__(self, cls, path):
+    self.cls = cls
+    self._size = cls._packer().size
+    self._file = open(path, 'rb')
+    length = os.fstat(self._file.fileno()).st_size
+    if length % self._size:
+      self._file.close()
+      raise ValueError('{} is not a whole number of {} byte {} records'.format(
+        path, self._size, cls.__name__))
+    self._count = length // self._size
+    # an empty file can't be mapped
+    self._map = mmap.mmap(self._file.fileno(), 0, access=mmap.ACCESS_READ) \
+      if length else b''
+
+  def __len__(self):
+    return self._count
+
+  def __getitem__(self, index):
+    if isinstance(index, slice):
+      start, stop, step = index.indices(self._count)
+      if step == 1:
+        with memoryview(self._map)[start * self._size:max(start, stop) * self._size] \
+            as view:
+          return list(self.cls.iter_from_buffer(view))
+      return [self[i] for i in range(start, stop, step)]
+    if index < 0:
+      index += self._count
+    if not 0 <= index < self._count:
+      raise IndexError('record index out of range')
+    return self.cls.from_bytes(self._map, index * self._size)
+
+  def __iter__(self):
+    # the memoryview has to be released before the map can be closed
+    with memoryview(self._map) as view:
+      yield from self.cls.iter_from_buffer(view)
+
+  def close(self):
+    if isinstance(self._map, mmap.mmap):
+      self._map.close()
+    self._file.close()
+
+  def __enter__(self):
+    return self
+
+  def __exit__(self, *exc_info):
+    self.close()
+
 class Stock(StructTuple):
   _fields = ['name', 'shares', 'price']
 
@@ -54,6 +211,44 @@ class Point(StructTuple):
   _fields = ['x', 'y']
 
 # the magic must happen at this point
-import pdb; pdb.set_trace()
 s = Stock('ACME', 50, 91.1)
 print(s.price)
+
+class PackedStock(StructTuple):
+  _fields = ['name', 'shares', 'price']
+  _formats = ['8s', 'i', 'd']
+
+class PackedPoint(StructTuple):
+  _fields = ['x', 'y']
+  _formats = ['d', 'd']
+
+def benchmark_record_file(count=10**6, lookups=100000):
+  '''write count PackedStock records, then time random access and a full
+  pass through a RecordFile'''
+  with tempfile.TemporaryDirectory() as directory:
+    path = os.path.join(directory, 'stocks.bin')
+    records = (PackedStock('S{}'.format(i % 1000), i, i * 0.5) for i in range(count))
+    start = time.perf_counter()
+    PackedStock.write_records(path, records)
+    print('write     {:8.1f} ns per record'.format(
+      (time.perf_counter() - start) / count * 1e9))
+    with RecordFile(PackedStock, path) as stocks:
+      indices = [random.randrange(count) for i in range(lookups)]
+      start = time.perf_counter()
+      for i in indices:
+        stocks[i]
+      print('stocks[i] {:8.1f} ns per record'.format(
+        (time.perf_counter() - start) / lookups * 1e9))
+      start = time.perf_counter()
+      for stock in stocks:
+        pass
+      print('iterate   {:8.1f} ns per record'.format(
+        (time.perf_counter() - start) / count * 1e9))
+
+if __name__ == '__main__':
+  p = PackedStock('ACME', 50, 91.1)
+  data = p.to_bytes()
+  print(len(data), data, PackedStock.from_bytes(data).name)
+  points = b''.join(PackedPoint(i, -i).to_bytes() for i in range(3))
+  print([(q.x, q.y) for q in PackedPoint.iter_from_buffer(memoryview(points))])
+  benchmark_record_file()
@@ -1,15 +1,326 @@
 import time
-from functools import wraps
+import math
+import random
+import inspect
+from functools import wraps, partial
+from timeit import Timer
+
+# A log-linear (HDR style) histogram of nanosecond timings.  Values below
+# 2**_SUB_BITS land in their own bucket, above that every power of two is split
+# into 2**(_SUB_BITS-1) equal buckets, so each bucket is within ~3% of the
+# values it holds.  The bucket list is allocated once, so the memory used never
+# grows no matter how many calls are recorded.
+_SUB_BITS = 6
+_MAX_NS = 1 << 40  # ~18 minutes, anything slower is clamped into the top bucket
+
+def _bucket(ns):
+  if ns < (1 << _SUB_BITS):
+    return ns
+  shift = ns.bit_length() - _SUB_BITS
+  return (shift << (_SUB_BITS - 1)) + (ns >> shift)
+
+def _bucket_floor(index):
+  '''the smallest value that lands in the bucket at index'''
+  if index < (1 << _SUB_BITS):
+    return index
+  shift = (index >> (_SUB_BITS - 1)) - 1
+  return (index - (shift << (_SUB_BITS - 1))) << shift
+
+_BUCKETS = _bucket(_MAX_NS) + 1
+
+class Histogram:
+  '''fixed memory histogram of nanosecond durations'''
+  def __init__(self, counts=None, max_ns=0):
+    self.counts = counts if counts is not None else [0] * _BUCKETS
+    self.max_ns = max_ns
+
+  def record(self, ns, weight=1):
+    if ns >= _MAX_NS:
+      ns = _MAX_NS - 1
+    self.counts[_bucket(ns)] += weight
+    if ns > self.max_ns:
+      self.max_ns = ns
+
+  def reset(self):
+    # rebind rather than clear, so a caller half way through record() can only
+    # ever touch the old list
+    self.counts = [0] * _BUCKETS
+    self.max_ns = 0
+
+  def snapshot(self):
+    '''a frozen copy which can be read while traffic keeps recording'''
+    return Histogram(list(self.counts), self.max_ns)
+
+  @property
+  def count(self):
+    return sum(self.counts)
+
+  def percentile(self, p):
+    '''the (lower bound of the) bucket holding the p-th percentile in ns'''
+    counts = self.counts
+    total = sum(counts)
+    if total == 0:
+      return 0
+    rank = total * p / 100.0
+    seen = 0
+    for index, n in enumerate(counts):
+      seen += n
+      if n and seen >= rank:
+        return min(_bucket_floor(index), self.max_ns)
+    return self.max_ns
+
+  def summary(self):
+    snap = self.snapshot()
+    return {
+      'count': snap.count,
+      'p50': snap.percentile(50),
+      'p90': snap.percentile(90),
+      'p99': snap.percentile(99),
+      'max': snap.max_ns,
+    }
+
+# Calling a coroutine function, an async generator function or a generator
+# function only builds the coroutine or generator, the body runs later, one
+# step at a time, as it is awaited or iterated.  To time those we drive the
+# steps ourselves: wall time runs from the first step until the last one, busy
+# time only adds up the time spent inside of the steps, which (for a coroutine)
+# is the time it actually spent running on the event loop.
+
+def suspendable(fn):
+  '''is fn a coroutine, async generator or generator function'''
+  return (inspect.iscoroutinefunction(fn) or inspect.isasyncgenfunction(fn)
+    or inspect.isgeneratorfunction(fn))
+
+def _timed_steps(steps, busy, clock=time.perf_counter_ns):
+  '''run the steps of a generator or of an awaitable's iterator, forwarding
+  send/throw/close, and add the time spent inside of them to busy[0]'''
+  send = throw = None
+  while True:
+    start = clock()
+    try:
+      if throw is None:
+        item = steps.send(send)
+      else:
+        item = steps.throw(throw)
+    except StopIteration as stop:
+      return stop.value
+    finally:
+      busy[0] += clock() - start
+    send = throw = None
+    try:
+      send = yield item
+    except GeneratorExit:
+      steps.close()
+      raise
+    except BaseException as error:
+      throw = error
+
+class _Awaitable:
+  '''lets a coroutine await _timed_steps'''
+  __slots__ = ('_steps',)
+
+  def __init__(self, steps):
+    self._steps = steps
+
+  def __await__(self):
+    return self._steps
+
+def wrap_suspendable(fn, record, clock=time.perf_counter_ns):
+  '''wrap a coroutine, async generator or generator function so that
+  record(wall_ns, busy_ns) is called once it has run to completion'''
+  if inspect.iscoroutinefunction(fn):
+    @wraps(fn)
+    async def wrapper(*args, **kwargs):
+      busy = [0]
+      start = clock()
+      try:
+        return await _Awaitable(_timed_steps(fn(*args, **kwargs).__await__(), busy))
+      finally:
+        record(clock() - start, busy[0])
+
+  elif inspect.isasyncgenfunction(fn):
+    @wraps(fn)
+    async def wrapper(*args, **kwargs):
+      agen = fn(*args, **kwargs)
+      busy = [0]
+      start = clock()
+      # like yield from: values sent in go on with asend and exceptions
+      # thrown in with athrow (aclose is left to the finally clause)
+      value, error = None, None
+      try:
+        while True:
+          step = agen.asend(value) if error is None else agen.athrow(error)
+          value, error = None, None
+          try:
+            item = await _Awaitable(_timed_steps(step, busy))
+          except StopAsyncIteration:
+            return
+          try:
+            value = yield item
+          except GeneratorExit:
+            raise
+          except BaseException as e:
+            error = e
+      finally:
+        await agen.aclose()
+        record(clock() - start, busy[0])
+
+  elif inspect.isgeneratorfunction(fn):
+    @wraps(fn)
+    def wrapper(*args, **kwargs):
+      busy = [0]
+      start = clock()
+      try:
+        return (yield from _timed_steps(fn(*args, **kwargs), busy))
+      finally:
+        record(clock() - start, busy[0])
+
+  else:
+    raise TypeError('{!r} is not a coroutine, async generator or generator '
+      'function'.format(fn))
+  return wrapper
+
+def timethis(fn=None, *, aggregate=False):
+  '''decorator that reports the execution time
+
+  With aggregate=True nothing is printed, each call is recorded into
+  fn.histogram instead (see Histogram.summary).  Coroutine, async generator
+  and generator functions are timed until they finish, their wall time goes
+  into fn.histogram and the time they spent running into fn.busy_histogram.
+  '''
+  if fn is None:
+    return partial(timethis, aggregate=aggregate)
+
+  if suspendable(fn):
+    if not aggregate:
+      def record(wall_ns, busy_ns):
+        print(fn.__name__, wall_ns / 1e9, 'busy', busy_ns / 1e9)
+      return wrap_suspendable(fn, record)
+    histogram, busy_histogram = Histogram(), Histogram()
+    def record(wall_ns, busy_ns):
+      histogram.record(wall_ns)
+      busy_histogram.record(busy_ns)
+    wrapper = wrap_suspendable(fn, record)
+    wrapper.histogram, wrapper.busy_histogram = histogram, busy_histogram
+    return wrapper
+
+  if not aggregate:
+    @wraps(fn)
+    def wrapper(*args, **kwargs):
+      start = time.time()
+      result = fn(*args, **kwargs)
+      end = time.time()
+      print(fn.__name__, end-start)
+      return result
+    return wrapper
+
+  histogram = Histogram()
+  # Histogram.record is inlined here: an extra method call (and a call to
+  # _bucket) would cost more than the bucket arithmetic itself
+  clock = time.perf_counter_ns
+  linear, sub_bits, top = 1 << _SUB_BITS, _SUB_BITS, _MAX_NS - 1
 
-def timethis(fn):
-  '''decorator that reports the execution time'''
   @wraps(fn)
   def wrapper(*args, **kwargs):
-    start = time.time()
+    start = clock()
+    result = fn(*args, **kwargs)
+    ns = clock() - start
+    if ns < linear:
+      histogram.counts[ns] += 1
+    else:
+      if ns > top:
+        ns = top
+      shift = ns.bit_length() - sub_bits
+      histogram.counts[(shift << (sub_bits - 1)) + (ns >> shift)] += 1
+    if ns > histogram.max_ns:
+      histogram.max_ns = ns
+    return result
+  wrapper.histogram = histogram
+  return wrapper
+
+def timethis_sampled(fn=None, *, every=100, fraction=None, adaptive=False,
+    samples_per_second=1000):
+  '''a timethis for hot functions which only times some of the calls
+
+  every=N times every Nth call, fraction=f times a random fraction f of
+  the calls.  With adaptive=True the sampling period is re-tuned as the call
+  rate changes so that about samples_per_second calls get timed.  Each sample
+  is recorded with a weight equal to the number of calls it stands in for, so
+  fn.histogram.count and fn.stats() estimate all of the calls, not just the
+  timed ones.
+  '''
+  if fn is None:
+    return partial(timethis_sampled, every=every, fraction=fraction,
+      adaptive=adaptive, samples_per_second=samples_per_second)
+  if suspendable(fn):
+    raise TypeError('timethis_sampled only times plain functions, use '
+      'timethis(aggregate=True) for {}'.format(fn.__qualname__))
+  if fraction is not None and not 0 < fraction <= 1:
+    raise ValueError('fraction must be > 0 and <= 1, not {!r}'.format(fraction))
+  if every <= 0:
+    raise ValueError('every must be > 0, not {!r}'.format(every))
+  if samples_per_second <= 0:
+    raise ValueError('samples_per_second must be > 0, not {!r}'.format(
+      samples_per_second))
+
+  histogram = Histogram()
+  clock = time.perf_counter_ns
+  # every=N counts down a period, fraction=f draws gaps with probability f
+  period = every
+  probability = fraction
+  born = window_start = clock()
+  window_calls = samples = 0
+
+  def next_gap():
+    if probability is None:
+      return period
+    if probability >= 1.0:
+      return 1
+    # geometric gaps give every call the same chance of being timed, while
+    # the fast path below stays a plain countdown
+    return int(math.log(1.0 - random.random()) / math.log(1.0 - probability)) + 1
+
+  gap = skip = next_gap()
+
+  def timed_call(args, kwargs):
+    nonlocal gap, skip, period, probability, window_start, window_calls, samples
+    start = clock()
     result = fn(*args, **kwargs)
-    end = time.time()
-    print(fn.__name__, end-start)
+    end = clock()
+    histogram.record(end - start, gap)
+    samples += 1
+    window_calls += gap
+    if adaptive and end - window_start > 100000000:
+      rate = window_calls * 1e9 / (end - window_start)
+      if probability is None:
+        period = max(1, int(rate / samples_per_second))
+      else:
+        probability = min(1.0, samples_per_second / rate)
+      window_start, window_calls = end, 0
+    gap = skip = next_gap()
     return result
+
+  @wraps(fn)
+  def wrapper(*args, **kwargs):
+    nonlocal skip
+    skip -= 1
+    if skip > 0:
+      return fn(*args, **kwargs)
+    return timed_call(args, kwargs)
+
+  def stats():
+    '''estimated totals, scaled up from the sampled calls'''
+    calls = histogram.count
+    elapsed = (clock() - born) / 1e9
+    return {
+      'calls': calls,
+      'samples': samples,
+      'period': period if probability is None else 1 / probability,
+      'calls_per_second': calls / elapsed if elapsed else 0.0,
+    }
+
+  wrapper.histogram = histogram
+  wrapper.stats = stats
   return wrapper
 
 @timethis
@@ -18,10 +329,58 @@ def countdown(n):
   while n > 0:
     n -= 1
 
+def benchmark_aggregate_overhead(number=200000, repeat=5):
+  '''compare a ~1us function with its aggregating timethis version'''
+  def work():
+    n = 20
+    while n > 0:
+      n -= 1
+
+  timed_work = timethis(aggregate=True)(work)
+  bare = min(Timer(work).repeat(repeat, number)) / number * 1e9
+  timed = min(Timer(timed_work).repeat(repeat, number)) / number * 1e9
+  print('bare call:          {:8.1f} ns'.format(bare))
+  print('aggregated timethis:{:8.1f} ns'.format(timed))
+  print('overhead per call:  {:8.1f} ns'.format(timed - bare))
+  print(timed_work.histogram.summary())
+  return timed - bare
+
+def benchmark_sampled_overhead(number=500000, repeat=5):
+  '''the un-sampled path of timethis_sampled against a bare @wraps wrapper'''
+  def work():
+    pass
+
+  @wraps(work)
+  def bare(*args, **kwargs):
+    return work(*args, **kwargs)
+
+  # a huge period means every timed call is an un-sampled one (kept below
+  # 2**30 so the countdown stays a single digit int)
+  unsampled = timethis_sampled(every=10**9)(work)
+  sampled = timethis_sampled(every=100)(work)
+  results = {}
+  for name, f in (('bare @wraps', bare), ('un-sampled', unsampled),
+      ('every 100th', sampled)):
+    results[name] = min(Timer(f).repeat(repeat, number)) / number * 1e9
+    print('{:12} {:8.1f} ns'.format(name, results[name]))
+  print(sampled.stats())
+  return results
+
 
 if __name__ == '__main__':
   countdown(100000)
   countdown(1000000)
   countdown(10000000)
   countdown(100000000)
-  
+
+  fast_countdown = timethis(aggregate=True)(countdown.__wrapped__)
+  for i in range(1000):
+    fast_countdown(1000)
+  print(fast_countdown.histogram.summary())
+  benchmark_aggregate_overhead()
+
+  hot_countdown = timethis_sampled(adaptive=True)(countdown.__wrapped__)
+  for i in range(200000):
+    hot_countdown(10)
+  print(hot_countdown.stats(), hot_countdown.histogram.summary())
+  benchmark_sampled_overhead()
@@ -0,0 +1,235 @@
+# inspect.signature takes tens of microseconds, and the recipes ask for the
+# same signatures over and over: typeassert for every function it decorates,
+# MatchSignatureMeta for the method being overridden in every subclass (two
+# signatures per method per class), MultiMethod.register and make_sig for
+# every class they build.  In a big class hierarchy that adds up to a noticeable
+# part of the import time.
+#
+# This is one cache for all of them.  It is keyed (weakly) on the function,
+# class or partial being looked at, so it never keeps one alive.  A cached
+# signature is only handed back if the attributes inspect.signature reads to
+# make it (__signature__, __wrapped__, __code__, the defaults, the annotations,
+# a class's __init__ and __new__ ...) are still the same objects they were when
+# it was cached; setting any of them makes the next lookup a miss.  Anything
+# derived from a signature (see derived()) is cached with it and thrown away
+# with it.
+#
+#   from signature_cache import signature
+#   signature(func)          # inspect.signature(func), cached
+#   stats()                  # {'hits': ..., 'misses': ..., 'invalidations': ...}
+import types
+import inspect
+import weakref
+from functools import partial
+from operator import is_
+
+_FUNCTION_ATTRIBUTES = ('__signature__', '__wrapped__', '__code__',
+  '__defaults__', '__kwdefaults__', '__annotations__')
+_CLASS_ATTRIBUTES = ('__signature__', '__init__', '__new__', '__text_signature__')
+
+def _stamp(obj, stamp):
+  '''append the objects inspect.signature looks at to make obj's signature'''
+  if type(obj) is types.FunctionType:
+    # the common case, spelled out since it is on every lookup
+    attributes = obj.__dict__
+    wrapped = attributes.get('__wrapped__')
+    stamp.extend((attributes.get('__signature__'), wrapped, obj.__code__,
+      obj.__defaults__, obj.__kwdefaults__, obj.__annotations__))
+    if wrapped is not None:
+      _stamp(wrapped, stamp)
+    return stamp
+  if isinstance(obj, type):
+    stamp.extend(getattr(obj, name, None) for name in _CLASS_ATTRIBUTES)
+    stamp.append(type(obj).__call__)
+  elif isinstance(obj, partial):
+    stamp.extend((obj.func, obj.args, obj.keywords))
+    _stamp(obj.func, stamp)
+  else:
+    stamp.extend(getattr(obj, name, None) for name in _FUNCTION_ATTRIBUTES)
+  wrapped = getattr(obj, '__wrapped__', None)
+  if wrapped is not None and not isinstance(obj, partial):
+    # a signature follows __wrapped__, so it goes stale with the wrapped one
+    _stamp(wrapped, stamp)
+  return stamp
+
+class _Entry:
+  __slots__ = ('ref', 'stamp', 'signature', 'derived')
+
+  def __init__(self, ref, stamp):
+    self.ref = ref
+    self.stamp = stamp
+    self.signature = None     # made when it is first asked for
+    self.derived = {}
+
+class SignatureCache:
+  '''inspect.signature, remembered for as long as the object lives and
+  doesn't change'''
+  def __init__(self):
+    # id(obj) -> _Entry, the entry holds a weak reference to obj whose callback
+    # drops the entry.  This is what a WeakKeyDictionary does, but a lookup
+    # doesn't have to make a weak reference and functions don't need hashing.
+    self._entries = {}
+    self._names = {}
+    self.hits = self.misses = self.invalidations = 0
+
+  def _entry(self, obj):
+    stamp = _stamp(obj, [])
+    key = id(obj)
+    entry = self._entries.get(key)
+    if entry is not None and entry.ref() is obj:
+      if len(entry.stamp) == len(stamp) and all(map(is_, entry.stamp, stamp)):
+        self.hits += 1
+        return entry
+      self.invalidations += 1
+    self.misses += 1
+    entries = self._entries
+    try:
+      ref = weakref.ref(obj, lambda ref: entries.get(key) is entry and entries.pop(key))
+    except TypeError:
+      # obj can't be weakly referenced, so it isn't cached
+      return _Entry(None, stamp)
+    entry = entries[key] = _Entry(ref, stamp)
+    return entry
+
+  @staticmethod
+  def _signature(entry, obj):
+    if entry.signature is None:
+      entry.signature = inspect.signature(obj)
+    return entry.signature
+
+  def signature(self, obj):
+    '''inspect.signature(obj)'''
+    if isinstance(obj, types.MethodType):
+      # bound methods are made on every attribute lookup, cache the function
+      return self.derived(obj.__func__, 'bound', _bound_signature)
+    return self._signature(self._entry(obj), obj)
+
+  def derived(self, obj, name, compute):
+    '''compute(signature of obj), cached with the signature under name'''
+    entry = self._entry(obj)
+    try:
+      return entry.derived[name]
+    except KeyError:
+      value = entry.derived[name] = compute(self._signature(entry, obj))
+      return value
+
+  def comparable(self, obj):
+    '''a key with comparable(a) == comparable(b) when a and b have equal
+    signatures'''
+    if isinstance(obj, types.MethodType):
+      return _comparable(self.signature(obj))
+    entry = self._entry(obj)
+    try:
+      return entry.derived['comparable']
+    except KeyError:
+      pass
+    if (type(obj) is types.FunctionType and '__signature__' not in obj.__dict__
+        and '__wrapped__' not in obj.__dict__):
+      # a plain function's key can be read off of its code object without
+      # making the signature at all
+      key = _function_comparable(obj)
+    else:
+      key = _comparable(self._signature(entry, obj))
+    entry.derived['comparable'] = key
+    return key
+
+  def from_names(self, names, kind=inspect.Parameter.POSITIONAL_OR_KEYWORD):
+    '''a Signature of parameters called names, with no defaults'''
+    key = (tuple(names), kind)
+    try:
+      sig = self._names[key]
+    except KeyError:
+      self.misses += 1
+      sig = self._names[key] = inspect.Signature(
+        [inspect.Parameter(name, kind) for name in key[0]])
+    else:
+      self.hits += 1
+    return sig
+
+  def stats(self):
+    return {'hits': self.hits, 'misses': self.misses,
+      'invalidations': self.invalidations,
+      'entries': len(self._entries) + len(self._names)}
+
+  def clear(self):
+    self._entries.clear()
+    self._names.clear()
+    self.hits = self.misses = self.invalidations = 0
+
+# comparable() keys: two signatures are equal when their keys are, and
+# comparing two keys is much cheaper than Signature.__eq__ (which builds a
+# dict of each side every time).  A key is
+#
+#   (positional only count, positional names, *args name, keyword only names
+#    (sorted, their order doesn't matter), **kwargs name, defaults,
+#    keyword only defaults, annotations)
+#
+# laid out like a function's own attributes, so that a plain function's key
+# can be made straight from its code object (_function_comparable) and still
+# compare equal to one made from a signature (_comparable).
+def _function_comparable(func):
+  code = func.__code__
+  count, kwcount = code.co_argcount, code.co_kwonlyargcount
+  names = code.co_varnames
+  index = count + kwcount
+  varargs = varkw = None
+  if code.co_flags & inspect.CO_VARARGS:
+    varargs = names[index]
+    index += 1
+  if code.co_flags & inspect.CO_VARKEYWORDS:
+    varkw = names[index]
+  return (code.co_posonlyargcount, names[:count], varargs,
+    tuple(sorted(names[count:count + kwcount])), varkw, func.__defaults__,
+    func.__kwdefaults__ or None, func.__annotations__ or None)
+
+def _comparable(sig):
+  kind = inspect.Parameter
+  positional_only = 0
+  positional, keyword_only, defaults, kwdefaults, annotations = [], [], [], {}, {}
+  varargs = varkw = None
+  for param in sig.parameters.values():
+    if param.kind == kind.POSITIONAL_ONLY:
+      positional_only += 1
+    if param.kind in (kind.POSITIONAL_ONLY, kind.POSITIONAL_OR_KEYWORD):
+      positional.append(param.name)
+      if param.default is not kind.empty:
+        defaults.append(param.default)
+    elif param.kind == kind.KEYWORD_ONLY:
+      keyword_only.append(param.name)
+      if param.default is not kind.empty:
+        kwdefaults[param.name] = param.default
+    elif param.kind == kind.VAR_POSITIONAL:
+      varargs = param.name
+    else:
+      varkw = param.name
+    if param.annotation is not kind.empty:
+      annotations[param.name] = param.annotation
+  if sig.return_annotation is not sig.empty:
+    annotations['return'] = sig.return_annotation
+  return (positional_only, tuple(positional), varargs, tuple(sorted(keyword_only)),
+    varkw, tuple(defaults) or None, kwdefaults or None, annotations or None)
+
+def _bound_signature(sig):
+  '''the signature of a function bound to an instance, as inspect makes it'''
+  params = tuple(sig.parameters.values())
+  if not params or params[0].kind == inspect.Parameter.VAR_POSITIONAL:
+    return sig
+  return sig.replace(parameters=params[1:])
+
+_cache = SignatureCache()
+signature = _cache.signature
+derived = _cache.derived
+comparable = _cache.comparable
+from_names = _cache.from_names
+stats = _cache.stats
+clear = _cache.clear
+
+if __name__ == '__main__':
+  def spam(x, y=1, *, z):
+    pass
+
+  print(signature(spam), signature(spam), stats())
+  spam.__signature__ = inspect.Signature()
+  print(signature(spam), stats())
+  del spam.__signature__
+  print(signature(spam), stats())
@@ -6,13 +6,6 @@ from threading import Thread
 from collections import deque
 
 log_file = 'thread_safe_attribute.log'
-with open(log_file, 'w') as fp:
-  fp.write("")
-
-logging.basicConfig(
-  format='%(asctime)s:%(message)s',
-  filename=log_file,
-  level=logging.INFO)
 
 class A1():
   def __init__(self):
@@ -196,6 +189,14 @@ class A2(metaclass=MetaThreadSafeAttribute):
     self.c = c
 
 if __name__ == '__main__':
+  with open(log_file, 'w') as fp:
+    fp.write("")
+
+  logging.basicConfig(
+    format='%(asctime)s:%(message)s',
+    filename=log_file,
+    level=logging.INFO)
+
   a = A1()
   a.name = "bob"
   print(a.name)
@@ -1,6 +1,7 @@
 # Unwrapping a decorator
 import time
 from functools import wraps
+from timeit import Timer
 
 def timethis(fn):
   '''decorator that reports the execution time'''
@@ -19,6 +20,60 @@ def countdown(n):
   while n > 0:
     n -= 1
 
+# Since @wraps leaves a __wrapped__ attribute on every layer, we can walk down a
+# stack of decorators and time each layer against the one below it.  Whatever a
+# layer costs on top of the layer it wraps is the overhead of that decorator.
+
+def layers(func):
+  '''the decorated callable followed by every layer beneath it'''
+  chain = [func]
+  while hasattr(func, '__wrapped__'):
+    func = func.__wrapped__
+    chain.append(func)
+  return chain
+
+def layer_name(func):
+  '''name the decorator that made this layer (@wraps copies the __qualname__
+  of the wrapped function, so look at the code object instead)'''
+  code = getattr(func, '__code__', None)
+  if code is None:
+    return type(func).__name__
+  qualname = getattr(code, 'co_qualname', code.co_name)
+  return qualname.split('.<locals>')[0]
+
+def audit_layers(func, args=(), kwargs=None, repeat=7):
+  '''time every layer of a decorated callable with the same arguments
+
+  Returns one dict per layer, outermost first, with the time per call and
+  the overhead that layer adds to the one below it, in ns and as a percentage
+  of the undecorated function.
+  '''
+  kwargs = kwargs or {}
+  chain = layers(func)
+  timings = []
+  for layer in chain:
+    timer = Timer(lambda: layer(*args, **kwargs))
+    number, _ = timer.autorange()
+    timings.append(min(timer.repeat(repeat, number)) / number * 1e9)
+
+  bare = timings[-1]
+  rows = []
+  for index, layer in enumerate(chain):
+    below = timings[index + 1] if index + 1 < len(timings) else None
+    overhead = timings[index] - below if below is not None else 0.0
+    rows.append({
+      'layer': layer_name(layer) if below is not None else layer.__qualname__,
+      'ns': timings[index],
+      'overhead_ns': overhead,
+      'overhead_percent': overhead / bare * 100,
+    })
+  return rows
+
+def print_audit(rows):
+  print('{:40} {:>12} {:>14} {:>10}'.format('layer', 'ns/call', 'overhead ns', '%'))
+  for row in rows:
+    print('{layer:40} {ns:12.1f} {overhead_ns:14.1f} {overhead_percent:9.1f}%'.format(**row))
+
 
 if __name__ == '__main__':
   countdown(100000)
@@ -30,3 +85,22 @@ if __name__ == '__main__':
   orginal_countdown = countdown.__wrapped__
   orginal_countdown(100000)
 
+  # audit a stack of the decorators from the other recipes
+  import logging
+  from putting_a_wrapper_around_a_function_1 import timethis as aggregated
+  from wrapper_with_arguments_6 import logged
+  from type_checking_with_a_decorator_7 import typeassert
+
+  log = logging.getLogger('audit')
+  log.propagate = False
+  log.addHandler(logging.NullHandler())
+
+  @aggregated(aggregate=True)
+  @logged(name='audit')
+  @typeassert(int)
+  def countdown(n):
+    '''counts down'''
+    while n > 0:
+      n -= 1
+
+  print_audit(audit_layers(countdown, args=(10,)))
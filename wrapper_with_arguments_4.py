@@ -1,17 +1,139 @@
 # Defining a Decorator that takes arguments
 from functools import wraps
+from timeit import Timer
+import os
+import time
 import logging
+import weakref
+import tempfile
 
 # Without the following line, nothing will show up.
 # the basicConfig must be called before using the logger
 logging.basicConfig(level=logging.DEBUG)
 
-def logged(level, name=None, message=None):
+# A logged function whose level is disabled shouldn't pay for a log.log call on
+# every call.  So each wrapper comes as a pair of functions: the wrapper which
+# logs and a pass-through which just calls func.  When logging is off, the
+# pass-through's code object is swapped into the wrapper (wrapper.__code__), so
+# the wrapper keeps its identity (and everything attached to it) but no longer
+# looks at the logger at all.  A code object can only be swapped for another
+# with the same free variables, so the pass-through names them in an `if 0:`
+# block which the compiler throws away.
+#
+# A wrapper only looks at its logger again when it is re-specialized: call
+# refresh_logged() after changing the logging configuration.  install() makes
+# setLevel and logging.disable do that by themselves, by hooking a private
+# part of logging, so it is left to the program to ask for it.
+
+# every logged wrapper, so they can be re-specialized when the logging
+# configuration changes
+_logged_wrappers = weakref.WeakSet()
+
+def specialize(wrapper, passthrough, enabled):
+  '''swap wrapper's code for passthrough's whenever enabled() is false
+
+  wrapper.respecialize() checks enabled() again, refresh_logged() calls it
+  for every wrapper.
+  '''
+  if wrapper.__code__.co_freevars != passthrough.__code__.co_freevars:
+    raise ValueError('{} and its pass-through must use the same free '
+      'variables'.format(wrapper.__qualname__))
+  logging_code = wrapper.__code__
+
+  def respecialize():
+    wrapper.__code__ = logging_code if enabled() else passthrough.__code__
+
+  wrapper.respecialize = respecialize
+  watch(wrapper)
+  return wrapper
+
+def watch(wrapper):
+  '''call wrapper.respecialize() now and whenever refresh_logged() is
+  called'''
+  _logged_wrappers.add(wrapper)
+  wrapper.respecialize()
+
+def refresh_logged():
+  '''re-specialize every logged wrapper, the way to have them see a change
+  to the logging configuration (a logger's level, logging.disable,
+  logging.config...)'''
+  for wrapper in list(_logged_wrappers):
+    wrapper.respecialize()
+
+def install():
+  '''call refresh_logged() whenever Logger.setLevel or logging.disable is
+  called
+
+  They both clear the logging manager's isEnabledFor cache, so this wraps the
+  manager's _clear_cache, which is not a public API: it is a global change
+  made only if the program asks for it.  Anything that doesn't clear the
+  cache isn't seen, such as setting logger.level or logger.disabled (which
+  logging.config.dictConfig and fileConfig do for the existing loggers), call
+  refresh_logged() after those.
+  '''
+  manager = logging.Logger.manager
+  clear_cache = manager._clear_cache
+  if getattr(clear_cache, 'refreshes_logged', False):
+    return
+
+  def _clear_cache():
+    clear_cache()
+    refresh_logged()
+  _clear_cache.refreshes_logged = True
+  manager._clear_cache = _clear_cache
+
+class RateLimiter:
+  '''let at most `messages` log lines through every `seconds` seconds
+
+  This is a token bucket, written as the generic cell rate algorithm so that
+  check() is one clock read and a comparison: each line pushes a theoretical
+  arrival time `interval` into the future, and a line is only let through if
+  that time isn't more than a bucket's worth ahead of now.
+
+  check() returns -1 if the line should be dropped, otherwise the number of
+  lines dropped since the last one let through, so the caller can fold them
+  into "repeated N times in the last T seconds".  Under threads the counts are
+  approximate (there is no lock), which is fine for a log.
+  '''
+  # since is when the first of the lines being suppressed was dropped
+  __slots__ = ('interval', 'tolerance', 'tat', 'suppressed', 'since')
+  clock = staticmethod(time.monotonic)
+
+  def __init__(self, messages, seconds=1.0):
+    self.interval = seconds / messages
+    self.tolerance = seconds - self.interval
+    self.tat = self.since = self.clock()
+    self.suppressed = 0
+
+  def check(self):
+    now = self.clock()
+    tat = self.tat
+    if tat - now > self.tolerance:
+      if not self.suppressed:
+        self.since = now
+      self.suppressed += 1
+      return -1
+    self.tat = (tat if tat > now else now) + self.interval
+    suppressed = self.suppressed
+    if suppressed:
+      self.suppressed = 0
+    return suppressed
+
+  def folded(self, logmsg, suppressed):
+    '''the message which stands for suppressed dropped lines and this one'''
+    seconds = self.clock() - self.since
+    return '{} (repeated {} times in the last {:.2f} seconds)'.format(
+      logmsg, suppressed + 1, seconds)
+
+def logged(level, name=None, message=None, rate=None):
   '''
   Add logging to a function.  level is the logging
   level, name is the logger name, and message is the
   log message.  If name and message aren't specified,
   they default to the funtion's module and name.
+  rate=(messages, seconds) limits how many lines are
+  written, lines over the limit are folded into a
+  "repeated N times" line.
   '''
   def decorate(func):
     logname = name if name else func.__module__
@@ -19,11 +141,35 @@ def logged(level, name=None, message=None):
     log = logging.getLogger(logname)
     logmsg = message if message else func.__name__
 
+    if rate is not None:
+      limiter = RateLimiter(*rate)
+      check = limiter.check
+
+      @wraps(func)
+      def wrapper(*args, **kwargs):
+        suppressed = check()
+        if suppressed == 0:
+          log.log(level, logmsg)
+        elif suppressed > 0:
+          log.log(level, limiter.folded(logmsg, suppressed))
+        return func(*args, **kwargs)
+
+      def passthrough(*args, **kwargs):
+        if 0: check, limiter, log, level, logmsg
+        return func(*args, **kwargs)
+
+      return specialize(wrapper, passthrough, lambda: log.isEnabledFor(level))
+
     @wraps(func)
     def wrapper(*args, **kwargs):
       log.log(level, logmsg)
       return func(*args, **kwargs)
-    return wrapper
+
+    def passthrough(*args, **kwargs):
+      if 0: log, level, logmsg
+      return func(*args, **kwargs)
+
+    return specialize(wrapper, passthrough, lambda: log.isEnabledFor(level))
   return decorate
 
 # example use
@@ -35,6 +181,61 @@ def add(x, y):
 def spam():
   print('Spam!')
 
+def benchmark_disabled(number=500000, repeat=5):
+  '''a call to a logged function whose level is turned off'''
+  def bare(x, y):
+    return x + y
+
+  def always_log(func):
+    log = logging.getLogger('benchmark.disabled')
+    @wraps(func)
+    def wrapper(*args, **kwargs):
+      log.log(logging.DEBUG, 'bare')
+      return func(*args, **kwargs)
+    return wrapper
+
+  logging.getLogger('benchmark.disabled').setLevel(logging.WARNING)
+  disabled = logged(logging.DEBUG, 'benchmark.disabled')(bare)
+  for label, f in (('bare', bare), ('log.log every call', always_log(bare)),
+      ('specialized', disabled)):
+    cost = min(Timer(lambda: f(1, 2)).repeat(repeat, number)) / number * 1e9
+    print('{:20} {:8.1f} ns'.format(label, cost))
+
+def benchmark_rate_limited(calls=200000):
+  '''a logged function called as fast as possible, writing to a file with and
+  without a rate limit'''
+  with tempfile.TemporaryDirectory() as directory:
+    for label, rate in (('unlimited', None), ('rate=(10, 1.0)', (10, 1.0))):
+      filename = os.path.join(directory, 'spam.log')
+      log = logging.getLogger('benchmark.rate.' + str(rate))
+      log.propagate = False
+      handler = logging.FileHandler(filename, mode='w')
+      log.addHandler(handler)
+
+      @logged(logging.CRITICAL, log.name, 'spam', rate=rate)
+      def spam():
+        pass
+
+      start = time.perf_counter()
+      for i in range(calls):
+        spam()
+      elapsed = time.perf_counter() - start
+      handler.close()
+      with open(filename) as fp:
+        lines = fp.readlines()
+      print('{:16} {:10.0f} calls/s {:8} lines written, last: {}'.format(
+        label, calls / elapsed, len(lines), lines[-1].strip()))
+
 if __name__ == '__main__':
   add(1, 2)
   spam()
+
+  # turn it off and on again
+  logging.getLogger(__name__).setLevel(logging.INFO)
+  refresh_logged()
+  add(1, 2)
+  install()
+  logging.getLogger(__name__).setLevel(logging.DEBUG)
+  add(1, 2)
+  benchmark_disabled()
+  benchmark_rate_limited()
@@ -3,6 +3,9 @@ from functools import wraps, partial
 import logging
 logging.basicConfig(level=logging.DEBUG)
 
+# the wrapper is swapped for a pass-through while its level is disabled
+from wrapper_with_arguments_4 import specialize
+
 # func = decorator(x, y, z)(func)
 # so this given wrapper, returns a function, then it calls this function again
 # with func..
@@ -36,18 +39,24 @@ def logged(level, name=None, message=None):
       log.log(level, logmsg)
       return func(*args, **kwargs)
 
+    def passthrough(*args, **kwargs):
+      if 0: log, level, logmsg
+      return func(*args, **kwargs)
+
     # attach setter functions
     @attach_wrapper(wrapper)
     def set_level(new_level):
       nonlocal level  # reaches out
       level = new_level
+      wrapper.respecialize()
 
     @attach_wrapper(wrapper)
     def set_message(newmsg):
       nonlocal logmsg  # reaches out
       logmsg = newmsg
+      wrapper.respecialize()
 
-    return wrapper
+    return specialize(wrapper, passthrough, lambda: log.isEnabledFor(level))
   return decorate
 
 # example use
@@ -1,21 +1,359 @@
 # Defining a Decorator that takes an optional argument
 from functools import wraps, partial
+from collections import deque
+import os
+import sys
+import mmap
+import time
+import glob
+import struct
+import pickle
+import atexit
+import marshal
 import logging
+import argparse
+import tempfile
+import threading
 logging.basicConfig(level=logging.DEBUG)
 
-def logged(func=None, *, level=logging.DEBUG, name=None, message=None):
+# the wrapper is swapped for a pass-through while its level is disabled
+from wrapper_with_arguments_4 import specialize, RateLimiter
+
+class QueueSink:
+  '''hand log calls to a background thread instead of doing handler I/O on
+  the caller's thread
+
+  put() only appends a tuple to a bounded deque (deque.append is atomic, so
+  the caller takes no lock unless the queue is full).  A background thread
+  wakes up every interval seconds, or as soon as batch_size records are
+  waiting, and turns them into LogRecords and hands them to the logger's
+  handlers in batches.
+
+  When the queue holds maxsize records, overflow decides what happens:
+    'drop'   - the new record is dropped
+    'block'  - the caller waits for the background thread to make room
+    'sample' - every sample_every-th overflowing record replaces the oldest
+               queued one, the rest are dropped
+  dropped counts the records that were lost.  The queue is flushed when the
+  interpreter exits.
+  '''
+  def __init__(self, maxsize=10000, overflow='drop', batch_size=512,
+      interval=0.05, sample_every=100):
+    if overflow not in ('drop', 'block', 'sample'):
+      raise ValueError('overflow must be drop, block or sample')
+    self._queue = deque()
+    self._maxsize = maxsize
+    self._overflow = overflow
+    self._batch_size = batch_size
+    self._interval = interval
+    self._sample_every = sample_every
+    self._overflowed = 0
+    self.dropped = 0
+    self._closed = False
+    self._wakeup = threading.Event()
+    self._not_full = threading.Condition()
+    self._drain_lock = threading.Lock()
+    self._thread = threading.Thread(target=self._run, name='QueueSink', daemon=True)
+    self._thread.start()
+    atexit.register(self.close)
+
+  def put(self, log, level, msg):
+    queue = self._queue
+    if len(queue) < self._maxsize:
+      queue.append((log, level, msg, time.time(), threading.get_ident()))
+      if len(queue) == self._batch_size:
+        self._wakeup.set()
+    else:
+      self._put_overflow((log, level, msg, time.time(), threading.get_ident()))
+
+  def _put_overflow(self, item):
+    self._wakeup.set()
+    if self._overflow == 'block':
+      with self._not_full:
+        while len(self._queue) >= self._maxsize and not self._closed:
+          self._not_full.wait(self._interval)
+      self._queue.append(item)
+    elif self._overflow == 'sample':
+      self._overflowed += 1
+      if self._overflowed % self._sample_every:
+        self.dropped += 1
+        return
+      try:
+        self._queue.popleft()
+        self.dropped += 1
+      except IndexError:
+        pass
+      self._queue.append(item)
+    else:
+      self.dropped += 1
+
+  def _drain(self):
+    queue = self._queue
+    with self._drain_lock:
+      while queue:
+        batch = [queue.popleft() for i in range(min(self._batch_size, len(queue)))]
+        with self._not_full:
+          self._not_full.notify_all()
+        for log, level, msg, created, thread in batch:
+          record = log.makeRecord(log.name, level, '(QueueSink)', 0, msg, (), None)
+          record.created = created
+          record.msecs = (created - int(created)) * 1000
+          record.thread = thread
+          log.handle(record)
+
+  def _run(self):
+    while not self._closed:
+      self._wakeup.wait(self._interval)
+      self._wakeup.clear()
+      self._drain()
+
+  def flush(self):
+    '''write everything queued so far, on the caller's thread'''
+    self._drain()
+
+  def close(self):
+    if self._closed:
+      return
+    self._closed = True
+    self._wakeup.set()
+    self._thread.join()
+    self.flush()
+    with self._not_full:
+      self._not_full.notify_all()
+
+# A capture file is a run of length prefixed binary records:
+#
+#   size (uint32, header included), function id (uint16), codec (uint8),
+#   time in ns (int64), payload (size - 15 bytes)
+#
+# The payload of a call is (args, kwargs, result, raised) serialized with
+# marshal, or pickle if marshal can't handle the arguments.  If neither can, only
+# the type names of the arguments are kept.  Function names are written once,
+# as _NAME records, so a call record only carries the function's id.  The files
+# are preallocated and memory-mapped, a record size of zero marks the end.
+_HEADER = struct.Struct('<IHBq')
+_NAME, _MARSHAL, _PICKLE, _TYPES = range(4)
+
+def _type_names(call):
+  args, kwargs, result, raised = call
+  return marshal.dumps((tuple(type(a).__qualname__ for a in args),
+    {k: type(v).__qualname__ for k, v in kwargs.items()},
+    type(result).__qualname__, raised))
+
+class CaptureLog:
+  '''a memory-mapped, rolling binary log of calls and their results
+
+  Records go into path.0, path.1, ... each file_size bytes long, only the last
+  keep files are kept.  The files of an earlier log on the same path are
+  removed when it starts, so they can't be read back as part of this one.
+  Read them back with read_capture(path).  A call too
+  big for a file is written with only its type names, or if even that is too
+  big, dropped and counted in dropped; writing never fails the call.
+  '''
+  def __init__(self, path, file_size=64 * 1024 * 1024, keep=4):
+    self.path = path
+    self._file_size = file_size
+    self._keep = keep
+    self._lock = threading.Lock()
+    self._names = []
+    self._number = -1
+    self.dropped = 0
+    self._mm = None
+    for filename in _capture_files(path):
+      os.remove(filename)
+    self._roll()
+    atexit.register(self.close)
+
+  def _roll(self):
+    self._close_file()
+    self._number += 1
+    filename = '{}.{}'.format(self.path, self._number)
+    with open(filename, 'wb') as fp:
+      fp.truncate(self._file_size)
+    self._fp = open(filename, 'r+b')
+    self._mm = mmap.mmap(self._fp.fileno(), self._file_size)
+    self._offset = 0
+    stale = '{}.{}'.format(self.path, self._number - self._keep)
+    if os.path.exists(stale):
+      os.remove(stale)
+    # every file starts with the function names, so it can be read on its own
+    for func_id, name in enumerate(self._names):
+      self._append(func_id, _NAME, 0, name.encode('utf-8'))
+
+  def _close_file(self):
+    if self._mm is not None:
+      self._mm.close()
+      # trim the unused, preallocated tail
+      self._fp.truncate(self._offset)
+      self._fp.close()
+      self._mm = None
+
+  def _append(self, func_id, codec, when, payload):
+    size = _HEADER.size + len(payload)
+    if self._offset + size + _HEADER.size > self._file_size:
+      if self._offset == 0 or size + _HEADER.size > self._file_size:
+        raise ValueError('a {} byte record doesn\'t fit in a capture file'.format(size))
+      self._roll()
+    offset = self._offset
+    _HEADER.pack_into(self._mm, offset, size, func_id, codec, when)
+    self._mm[offset + _HEADER.size:offset + size] = payload
+    self._offset = offset + size
+
+  def register(self, func):
+    '''the id which func's calls are written under'''
+    with self._lock:
+      self._names.append('{}.{}'.format(func.__module__, func.__qualname__))
+      func_id = len(self._names) - 1
+      self._append(func_id, _NAME, 0, self._names[-1].encode('utf-8'))
+    return func_id
+
+  def write(self, func_id, args, kwargs, result, raised):
+    when = time.time_ns()
+    call = (args, kwargs, result, raised)
+    try:
+      codec, payload = _MARSHAL, marshal.dumps(call)
+    except ValueError:
+      try:
+        codec, payload = _PICKLE, pickle.dumps(call, pickle.HIGHEST_PROTOCOL)
+      except Exception:
+        codec, payload = _TYPES, _type_names(call)
+    # a record has to fit in a file along with the end marker
+    room = self._file_size - 2 * _HEADER.size
+    if len(payload) > room and codec != _TYPES:
+      codec, payload = _TYPES, _type_names(call)
+    with self._lock:
+      if len(payload) > room:
+        self.dropped += 1
+      elif self._mm is not None:
+        self._append(func_id, codec, when, payload)
+
+  def close(self):
+    with self._lock:
+      self._close_file()
+
+def _capture_files(path):
+  '''the files path.0, path.1, ... of a CaptureLog, in order'''
+  filenames = [filename for filename in glob.glob(glob.escape(path) + '.*')
+    if filename.rsplit('.', 1)[1].isdigit()]
+  return sorted(filenames, key=lambda filename: int(filename.rsplit('.', 1)[1]))
+
+def read_capture(path):
+  '''yield (time_ns, function name, args, kwargs, result, raised) for every
+  call in a capture file (path.N), or in all of the files of a CaptureLog'''
+  if os.path.exists(path):
+    filenames = [path]
+  else:
+    filenames = _capture_files(path)
+  for filename in filenames:
+    names = {}
+    with open(filename, 'rb') as fp:
+      data = fp.read()
+    offset = 0
+    while offset + _HEADER.size <= len(data):
+      size, func_id, codec, when = _HEADER.unpack_from(data, offset)
+      if size == 0:
+        break
+      payload = data[offset + _HEADER.size:offset + size]
+      offset += size
+      if codec == _NAME:
+        names[func_id] = payload.decode('utf-8')
+        continue
+      if codec == _PICKLE:
+        try:
+          args, kwargs, result, raised = pickle.loads(payload)
+        except Exception as error:
+          # a class which can't be imported here
+          args, kwargs, result, raised = ('<unpickleable: {}>'.format(error),), {}, None, False
+      else:
+        args, kwargs, result, raised = marshal.loads(payload)
+      yield when, names.get(func_id, func_id), args, kwargs, result, raised
+
+def logged(func=None, *, level=logging.DEBUG, name=None, message=None, sink=None,
+    capture=None, rate=None):
+  '''log a message every time func is called, through sink (a QueueSink)
+  if one is given rather than on the caller's thread
+
+  With capture (a CaptureLog) the arguments, return value (or the name of the
+  exception raised) of each call are written to the capture file instead of
+  logging a message, while the level is enabled.
+
+  rate=(messages, seconds) lets at most that many messages through, the ones
+  over the limit are counted and folded into the next message let through as
+  "repeated N times in the last T seconds".  It limits captured calls too
+  (those aren't counted).
+  '''
   if func is None:
-    return partial(logged, level=level, name=name, message=message)
+    return partial(logged, level=level, name=name, message=message, sink=sink,
+      capture=capture, rate=rate)
 
   logname = name if name else func.__module__
   log = logging.getLogger(logname)
   logmsg = message if message else func.__name__
 
+  limiter = RateLimiter(*rate) if rate is not None else None
+
+  if capture is not None:
+    write = capture.write
+    func_id = capture.register(func)
+    if limiter is not None:
+      # drop the calls over the limit, without a message there is nothing to
+      # fold the count into
+      unlimited_write, check = write, limiter.check
+      def write(*record):
+        if check() >= 0:
+          unlimited_write(*record)
+
+    @wraps(func)
+    def wrapper(*args, **kwargs):
+      try:
+        result = func(*args, **kwargs)
+      except BaseException as error:
+        write(func_id, args, kwargs, type(error).__qualname__, True)
+        raise
+      write(func_id, args, kwargs, result, False)
+      return result
+
+    def passthrough(*args, **kwargs):
+      if 0: write, func_id
+      return func(*args, **kwargs)
+
+    return specialize(wrapper, passthrough, lambda: log.isEnabledFor(level))
+
+  if sink is None:
+    emit = partial(log.log, level, logmsg)
+    emit_message = partial(log.log, level)
+  else:
+    emit = partial(sink.put, log, level, logmsg)
+    emit_message = partial(sink.put, log, level)
+
+  if limiter is not None:
+    check = limiter.check
+
+    @wraps(func)
+    def wrapper(*args, **kwargs):
+      suppressed = check()
+      if suppressed == 0:
+        emit()
+      elif suppressed > 0:
+        emit_message(limiter.folded(logmsg, suppressed))
+      return func(*args, **kwargs)
+
+    def passthrough(*args, **kwargs):
+      if 0: check, emit, emit_message, limiter, logmsg
+      return func(*args, **kwargs)
+
+    return specialize(wrapper, passthrough, lambda: log.isEnabledFor(level))
+
   @wraps(func)
   def wrapper(*args, **kwargs):
-    log.log(level, logmsg)
+    emit()
+    return func(*args, **kwargs)
+
+  def passthrough(*args, **kwargs):
+    if 0: emit
     return func(*args, **kwargs)
-  return wrapper
+
+  return specialize(wrapper, passthrough, lambda: log.isEnabledFor(level))
 
 @logged
 def add(x, y):
@@ -25,6 +363,98 @@ def add(x, y):
 def spam():
   print("Spam!")
 
+def _caller_latency(f, calls):
+  latencies = []
+  clock = time.perf_counter_ns
+  start = clock()
+  for i in range(calls):
+    t = clock()
+    f(i)
+    latencies.append(clock() - t)
+  elapsed = (clock() - start) / 1e9
+  latencies.sort()
+  return calls / elapsed, latencies[len(latencies) // 2], latencies[int(len(latencies) * 0.99)]
+
+def benchmark_sink(calls=100000):
+  '''throughput and caller latency of logged writing to a file, synchronously
+  and through a QueueSink'''
+  with tempfile.TemporaryDirectory() as directory:
+    results = {}
+    for label, sink in (('synchronous', None), ('QueueSink', QueueSink())):
+      log = logging.getLogger('benchmark.sink.' + label)
+      log.propagate = False
+      log.setLevel(logging.DEBUG)
+      handler = logging.FileHandler(os.path.join(directory, label + '.log'))
+      handler.setFormatter(logging.Formatter('%(asctime)s:%(name)s:%(message)s'))
+      log.addHandler(handler)
+
+      @logged(name=log.name, sink=sink)
+      def work(i):
+        return i
+
+      results[label] = _caller_latency(work, calls)
+      if sink:
+        sink.close()
+      handler.close()
+      print('{:12} {:10.0f} calls/s  p50 {:8} ns  p99 {:8} ns'.format(
+        label, *results[label]))
+  return results
+
+def benchmark_capture(calls=100000):
+  '''a call logged with its arguments formatted into the message, against
+  the same call captured to a binary file'''
+  with tempfile.TemporaryDirectory() as directory:
+    log = logging.getLogger('benchmark.capture')
+    log.propagate = False
+    log.setLevel(logging.DEBUG)
+    handler = logging.FileHandler(os.path.join(directory, 'formatted.log'))
+    log.addHandler(handler)
+
+    def formatted(x, y, name='n'):
+      log.debug('formatted(%r, %r, name=%r) -> %r', x, y, name, x + y)
+      return x + y
+
+    capture = CaptureLog(os.path.join(directory, 'calls'))
+    @logged(name='benchmark.capture', capture=capture)
+    def captured(x, y, name='n'):
+      return x + y
+
+    for label, f in (('formatted', formatted), ('captured', captured)):
+      rate, p50, p99 = _caller_latency(lambda i: f(i, 2.5, name='spam'), calls)
+      print('{:10} {:10.0f} calls/s  p50 {:8} ns  p99 {:8} ns'.format(label, rate, p50, p99))
+    capture.close()
+    handler.close()
+    print(next(read_capture(os.path.join(directory, 'calls'))))
+
 if __name__ == '__main__':
+  parser = argparse.ArgumentParser()
+  parser.add_argument('--read', metavar='CAPTURE',
+    help='print the calls in a capture file (or the path of a CaptureLog)')
+  arguments = parser.parse_args()
+  if arguments.read:
+    for when, function, args, kwargs, result, raised in read_capture(arguments.read):
+      print('{:.6f} {}(*{!r}, **{!r}) {} {!r}'.format(when / 1e9, function,
+        args, kwargs, 'raised' if raised else '->', result))
+    sys.exit()
+
   add(3, 5)
   spam()
+
+  sink = QueueSink(overflow='block')
+  @logged(level=logging.INFO, message='queued add', sink=sink)
+  def queued_add(x, y):
+    return x + y
+  queued_add(1, 2)
+  sink.flush()
+
+  # a hot function logs twice, the rest of its calls are folded into the
+  # next message let through
+  @logged(level=logging.INFO, rate=(2, 0.1))
+  def hot(i):
+    return i
+  for i in range(200000):
+    hot(i)
+  time.sleep(0.1)
+  hot(0)
+  benchmark_sink()
+  benchmark_capture()
@@ -14,5 +14,6 @@ def optional_debug(func):
 def spam(a, b, c):
   print(a, b, c)
 
-spam(1,2,3)
-spam(1,2,3, debug=True)
+if __name__ == '__main__':
+  spam(1,2,3)
+  spam(1,2,3, debug=True)